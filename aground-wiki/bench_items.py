@@ -0,0 +1,54 @@
+"Compares the compiled extraction plan of items.py to the previous per-property extraction, over every item"
+
+import timeit
+
+from utils import cache
+from utils.cache import Element
+from utils.extraction import ExtractionPlan, common_properties, composite_properties
+from utils.inheritance import InheritanceResolver
+
+aggregated = cache.load()
+items = [item for _, item in InheritanceResolver(aggregated.index, "item").resolve_all()]
+
+
+def get_composite(node: Element, path: list[str]) -> list[str]:
+    if len(path) > 1:
+        results = []
+        for child in node.findall(path[0], None):
+            results.extend(get_composite(child, path[1:]))
+        return results
+    else:
+        return [node.get(path[0], None)]
+
+
+def legacy_extract(item: Element) -> dict:
+    "The previous extraction: one `get` per property, one `findall` per path segment, then a cleanup pass"
+    result = {
+        **{prop: item.get(prop, None) for prop in common_properties},
+        **{
+            '_'.join(composite_path): get_composite(item, composite_path)
+            for composite_path in composite_properties
+        },
+    }
+    for key, val in list(result.items()):
+        if isinstance(val, list):
+            val = list(filter(None, val))
+            if len(val) == 1:
+                val = val[0]
+                result[key] = val
+        if not val:
+            del result[key]
+    return result
+
+
+plan = ExtractionPlan(common_properties, composite_properties)
+
+for item in items:
+    assert plan.extract(item) == legacy_extract(item), item.get("id", None)
+
+repeat = 20
+legacy = min(timeit.repeat(lambda: [legacy_extract(item) for item in items], number=1, repeat=repeat))
+compiled = min(timeit.repeat(lambda: [plan.extract(item) for item in items], number=1, repeat=repeat))
+print(f"{len(items)} items")
+print(f"legacy:   {legacy * 1000:.2f} ms")
+print(f"compiled: {compiled * 1000:.2f} ms ({legacy / compiled:.1f}x)")
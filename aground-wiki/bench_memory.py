@@ -0,0 +1,53 @@
+"Measures the memory used by holding every parsed file of the data folder at once, for each XmlNode representation"
+
+from pathlib import Path
+import gc
+import tracemalloc
+
+from xmlparser import XmlNode, parse
+
+data_folder = Path("data")
+
+
+class LegacyXmlNode:
+    "The previous representation: an instance __dict__, and its own dict and list even when empty"
+    def __init__(self, name: str, attributes: dict[str, str], children: list["LegacyXmlNode"], text: str):
+        self.name = name
+        self.attributes = attributes
+        self.children = children
+        self.text = text
+
+
+def to_legacy(node: XmlNode) -> LegacyXmlNode:
+    return LegacyXmlNode(
+        node.name,
+        dict(node.attributes),
+        [to_legacy(child) for child in node.children],
+        node.text,
+    )
+
+
+def measure(label: str, load) -> int:
+    "Print and return the memory retained by the result of `load()`"
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    data = load()
+    gc.collect()
+    retained = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    print(f"{label:<40} {retained / 1024 / 1024:>8.2f} MiB ({len(data)} files)")
+    del data
+    return retained
+
+
+files = {file: file.read_text("UTF-8") for file in data_folder.rglob("*.xml")}
+
+legacy = measure("legacy nodes", lambda: {file: to_legacy(parse(text)) for file, text in files.items()})
+slotted = measure("slotted nodes", lambda: {file: parse(text) for file, text in files.items()})
+stripped = measure(
+    "slotted nodes, no whitespace-only text",
+    lambda: {file: parse(text, keep_whitespace=False) for file, text in files.items()},
+)
+
+print(f"Reduction: {1 - slotted / legacy:.1%} (slotted), {1 - stripped / legacy:.1%} (without whitespace)")
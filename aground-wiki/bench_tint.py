@@ -0,0 +1,54 @@
+"Compares tinting the item icons in-process with Pillow to saving them first and running ImageMagick on each file"
+
+from pathlib import Path
+import tempfile
+import time
+
+from PIL import Image
+
+from item_icons import has_magick, hex_to_rgb, load_tile_image, load_tiles, load_tilesheets, tint_with_magick
+from utils import cache
+from utils.images import tint
+from utils.inheritance import InheritanceResolver
+
+aggregated = cache.load()
+index = aggregated.index
+tiles = load_tiles(index, load_tilesheets(index))
+
+icons: list[tuple[str, Image.Image, list[float]]] = []
+for _, item in InheritanceResolver(index, "item").resolve_all():
+    if item.get("icon", None) is None or item.get("color", None) is None:
+        continue
+    color_rgb = hex_to_rgb(item.get("color", None))
+    if (scale := item.get("colorScale", None)) is not None:
+        color_rgb = [i * float(scale) for i in color_rgb]
+    icons.append((item.get("id", None), load_tile_image(tiles[item.get("icon", None)]), color_rgb))
+print(f"{len(icons)} tinted icons")
+
+with tempfile.TemporaryDirectory() as folder:
+    pillow_folder = Path(folder) / "pillow"
+    magick_folder = Path(folder) / "magick"
+    pillow_folder.mkdir()
+    magick_folder.mkdir()
+
+    start = time.perf_counter()
+    for item_id, icon, color_rgb in icons:
+        tint(icon, color_rgb).save(pillow_folder / f"{item_id}.png")
+    pillow = time.perf_counter() - start
+    print(f"pillow: {pillow * 1000:.2f} ms")
+
+    if has_magick():
+        start = time.perf_counter()
+        for item_id, icon, color_rgb in icons:
+            icon.save(magick_folder / f"{item_id}.png")
+            tint_with_magick(color_rgb, magick_folder / f"{item_id}.png")
+        magick = time.perf_counter() - start
+        print(f"magick: {magick * 1000:.2f} ms ({magick / pillow:.1f}x slower)")
+
+        # Both should give the same pixels
+        different = [
+            item_id for item_id, _, _ in icons
+            if Image.open(pillow_folder / f"{item_id}.png").convert("RGBA").tobytes()
+            != Image.open(magick_folder / f"{item_id}.png").convert("RGBA").tobytes()
+        ]
+        print(f"{len(different)} icons differ: {different[:10]}")
@@ -0,0 +1,39 @@
+"Checks that resolving `extends` keeps the identity of every item: its own id and name, and so the keys of its translated name"
+
+from utils import cache
+from utils.inheritance import InheritanceResolver
+from utils.lang import LanguageTable
+
+aggregated = cache.load()
+index = aggregated.index
+lang = LanguageTable.from_index(index)
+
+
+def name_keys(item) -> tuple[str, ...]:
+    "Same keys as items.py"
+    if name := item.get("name", None):
+        return (name, f"item.names>{name}")
+    return (f"item.names>{item.get('id', None)}",)
+
+
+resolver = InheritanceResolver(index, "item")
+checked = 0
+failed = 0
+for source, item in index.by_tag("item"):
+    if item.get("extends", None) is None:
+        continue
+    resolved = resolver.resolve(item)
+    checked += 1
+    for attribute in ("id", "name"):
+        if resolved.get(attribute, None) != item.get(attribute, None):
+            failed += 1
+            print(f"{source} {item.get('id', None)}: {attribute} {item.get(attribute, None)!r} resolved as {resolved.get(attribute, None)!r}")
+    for locale in lang.loaded_locales():
+        expected = lang.lookup(locale, name_keys(item))
+        if (actual := lang.lookup(locale, name_keys(resolved))) != expected:
+            failed += 1
+            print(f"{source} {item.get('id', None)}: {locale} name {expected!r} resolved as {actual!r}")
+
+print(f"Checked {checked} items extending another one, {failed} differences")
+if failed:
+    raise SystemExit(1)
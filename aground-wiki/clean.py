@@ -2,38 +2,148 @@
 
 # import pathlib
 from pathlib import Path
+import argparse
+import hashlib
+import json
+import os
 import re
+from concurrent.futures import ProcessPoolExecutor
 
-from xmlparser import XmlNode, parse
+from utils.render import add_workers_argument
+from xmlparser import PARSER_VERSION, iterparse, write_events
 
 data_folder = Path("data")
 clean_folder = Path("clean")
+# Tracks what each file of the clean folder was built from, so that unchanged files can be skipped
+manifest_file = Path("clean.manifest.json")
+
+# Bump whenever a change to this script (e.g. the escaping) changes the output
+CLEAN_VERSION = 1
+VERSION = f"{PARSER_VERSION}.{CLEAN_VERSION}"
 
 replacements = {
     # '"': "&quot;",
     # "'": "&apos;",
-    r"<": "&lt;",
-    r">": "&gt;",
-    r"&(?!(gt;|lt;|amp;))": "&amp;",
+    "<": "&lt;",
+    ">": "&gt;",
+    "&": "&amp;",  # Only if it isn't already part of an escape sequence
 }
 
-replacements = [(re.compile(pattern), replacement) for pattern, replacement in replacements.items()]
+# All replacements in a single pass
+replacements_pattern = re.compile(r"[<>]|&(?!(gt;|lt;|amp;))")
+
+def _replace(match: re.Match) -> str:
+    return replacements[match.group()]
 
 def escape(string: str) -> str:
-    for pattern, replacement in replacements:
-        string = re.sub(pattern, replacement, string)
-    return string
+    # Most strings have nothing to escape
+    if "<" not in string and ">" not in string and "&" not in string:
+        return string
+    return replacements_pattern.sub(_replace, string)
 
-data: dict[Path, XmlNode] = {}
 
-for file in data_folder.rglob("*.xml"):
-    node = parse(file.read_text('UTF-8'))
-    data[file] = node
+def clean_file(file: Path) -> str | None:
+    "Convert a single file from the data folder into the clean folder. Returns an error message if it failed."
     cleaned_file = clean_folder / (file.relative_to(data_folder))
-    cleaned_file.parent.mkdir(parents=True, exist_ok=True)
+    # Written next to the cleaned file, then moved over it: a failure never leaves a truncated cleaned file
+    temp_file = cleaned_file.with_name(cleaned_file.name + ".tmp")
+    try:
+        cleaned_file.parent.mkdir(parents=True, exist_ok=True)
+
+        # Single pass: parse events are escaped and written as they come, without building a tree
+        with temp_file.open("w", encoding="UTF-8") as output:
+            write_events(iterparse(file.read_text('UTF-8')), output, escape)
+        os.replace(temp_file, cleaned_file)
+    except Exception as err:
+        temp_file.unlink(missing_ok=True)
+        return f"{type(err).__name__}: {err}"
+    return None
+
+
+def file_hash(file: Path) -> str:
+    return hashlib.sha256(file.read_bytes()).hexdigest()
+
+
+def load_manifest() -> dict[str, dict]:
+    "Load the manifest of the previous run, as {relative path: {size, mtime, hash, parser_version}}"
+    try:
+        return json.loads(manifest_file.read_text("UTF-8"))
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def is_up_to_date(file: Path, entry: dict | None, stat: os.stat_result) -> bool | None:
+    """Whether the cleaned version of `file` matches the manifest entry.
+    Returns None if only the content hash can tell (the file was touched, but may not have changed)."""
+    if entry is None or entry["parser_version"] != VERSION:
+        return False
+    if not (clean_folder / file.relative_to(data_folder)).exists():
+        return False
+    if entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime_ns:
+        return True
+    if entry["size"] != stat.st_size:
+        return False
+    return None
+
+
+def main():
+    argparser = argparse.ArgumentParser(description=__doc__)
+    add_workers_argument(argparser, "cleaning files")
+    argparser.add_argument(
+        "--force", action="store_true",
+        help="Clean every file again, even if unchanged (outputs of deleted files are still removed)",
+    )
+    args = argparser.parse_args()
+
+    # Loaded even with --force, to know which outputs belong to deleted files
+    previous_manifest = load_manifest()
+    manifest: dict[str, dict] = {}
+
+    # Only re-clean the files whose size, modification time or content changed
+    files: list[Path] = []
+    skipped = 0
+    for file in data_folder.rglob("*.xml"):
+        key = file.relative_to(data_folder).as_posix()
+        entry = previous_manifest.get(key)
+        stat = file.stat()
+        up_to_date = False if args.force else is_up_to_date(file, entry, stat)
+        content_hash = entry["hash"] if up_to_date else file_hash(file)
+        if up_to_date is None:
+            up_to_date = content_hash == entry["hash"]
+        manifest[key] = {
+            "size": stat.st_size,
+            "mtime": stat.st_mtime_ns,
+            "hash": content_hash,
+            "parser_version": VERSION,
+        }
+        if up_to_date:
+            skipped += 1
+        else:
+            files.append(file)
+
+    # Delete the outputs of the files that no longer exist
+    removed = previous_manifest.keys() - manifest.keys()
+    for key in removed:
+        (clean_folder / key).unlink(missing_ok=True)
+
+    if args.workers > 1 and len(files) > 1:
+        # Every file is independent, so each one is a work unit and only the errors are sent back
+        with ProcessPoolExecutor(max_workers=args.workers) as executor:
+            errors = list(executor.map(clean_file, files, chunksize=max(1, len(files) // (args.workers * 4))))
+    else:
+        errors = [clean_file(file) for file in files]
+
+    failed = [(file, error) for file, error in zip(files, errors) if error is not None]
+    for file, error in failed:
+        print(f"Failed to clean {file}: {error}")
+        # Make sure that it gets retried next time
+        del manifest[file.relative_to(data_folder).as_posix()]
+    manifest_file.write_text(json.dumps(manifest, indent=1, sort_keys=True), "UTF-8")
+
+    print(f"Rebuilt {len(files) - len(failed)}/{len(files)} files, skipped {skipped} unchanged, removed {len(removed)}")
+    if failed:
+        raise SystemExit(1)
 
-    for child in (node, *node.get_children(recursive=True)):
-        child.text = escape(child.text)
-        child.attributes = {key: escape(value) for key, value in child.attributes.items()}
 
-    cleaned_file.write_text(node.to_string(), encoding="UTF-8")
+if __name__ == "__main__":
+    main()
@@ -1,32 +1,73 @@
+"Renders every animation of every enemy, one PNG per frame"
+
 from pathlib import Path
-from lxml import etree
+import argparse
 
+from utils import cache
 from utils.images import TileManager
+from utils.inheritance import InheritanceResolver
+from utils.animation import FORMATS, animation_output
+from utils.render import Output, add_workers_argument, caches, render_all
 
 DATA_FOLDER = Path("data")
 
 output_folder = Path("output/enemy")
-output_folder.mkdir(parents=True, exist_ok=True)
-
-aggergated_file = Path("clean/aggregated.xml")
-aggregated_xml: etree._ElementTree = etree.parse(aggergated_file, None)
-
-manager = TileManager.from_aggregated_xml(DATA_FOLDER, aggregated_xml)
-
-_animations = list(manager.animations.values())
-anims: dict[str, list[tuple[str, str]]] = {}
-for animation_id in (anim.id for anim in _animations if '.' in anim.id):
-    base_object, animation_name = animation_id.rsplit('.', 1)
-    anims.setdefault(base_object, []).append((animation_id, animation_name))
-
-
-for source, enemy in manager.iterate_elements(aggregated_xml, "enemy"):
-    for animation_id, animation_name in anims.get(enemy.get("tile", None), []):        
-        frames, offsets = manager.get_tile_animation(enemy.get("tile", None), animation_id)
-        formatted = manager.format_animation(frames, offsets)
-        
-        folder: Path = output_folder / enemy.get("id", None)            
-        folder.mkdir(parents=True, exist_ok=True)
-        for i, frame in enumerate(formatted):
-            file = folder / f'{animation_id.replace('.', '_')}_{i}.png'
-            frame.save(file)
+
+
+def render_enemy(state: tuple[TileManager, str, bool], job: tuple[str, str, str]) -> list[Output]:
+    manager, output_format, use_shared_palette = state
+    enemy_id, tile, animation_id = job
+    formatted = manager.render_animation(tile, animation_id)
+    folder = output_folder / enemy_id
+    if output_format != "png":
+        file = folder / animation_id.replace('.', '_')
+        return [animation_output(file, formatted, output_format, use_shared_palette)]
+    return [
+        Output(folder / f'{animation_id.replace('.', '_')}_{i}.png', frame)
+        for i, frame in enumerate(formatted)
+    ]
+
+
+def main():
+    argparser = argparse.ArgumentParser(description=__doc__)
+    add_workers_argument(argparser)
+    argparser.add_argument(
+        "--format", choices=["png", *FORMATS], default="png",
+        help="png: one PNG per frame (default), otherwise a single animated file per animation",
+    )
+    argparser.add_argument(
+        "--shared-palette", action="store_true",
+        help="Quantize the frames of each animation to a single palette (apng and gif)",
+    )
+    args = argparser.parse_args()
+
+    output_folder.mkdir(parents=True, exist_ok=True)
+
+    aggregated = cache.load()
+
+    manager = TileManager.from_aggregated_data(DATA_FOLDER, aggregated)
+
+    _animations = list(manager.animations.values())
+    anims: dict[str, list[tuple[str, str]]] = {}
+    for animation_id in (anim.id for anim in _animations if '.' in anim.id):
+        base_object, animation_name = animation_id.rsplit('.', 1)
+        anims.setdefault(base_object, []).append((animation_id, animation_name))
+
+    # (enemy id, animation id) -> job, the last definition of an enemy wins
+    jobs: dict[tuple[str, str], tuple[str, str, str]] = {}
+    # Including everything inherited through `extends`
+    for source, enemy in InheritanceResolver(aggregated.index, "enemy").resolve_all():
+        for animation_id, animation_name in anims.get(enemy.get("tile", None), []):
+            (output_folder / enemy.get("id", None)).mkdir(parents=True, exist_ok=True)
+            jobs[enemy.get("id", None), animation_id] = (enemy.get("id", None), enemy.get("tile", None), animation_id)
+
+    state = (manager, args.format, args.shared_palette)
+    stats = render_all(
+        jobs.values(), lambda job: manager.tiles[job[1]].sheet.source_file, render_enemy, state,
+        workers=args.workers, get_caches=caches,
+    )
+    print(stats)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,29 +1,101 @@
+"Renders the animation of every item, one PNG per frame"
+
 from pathlib import Path
-from lxml import etree
+import argparse
 
+from utils import cache
 from utils.images import TileManager
+from utils.inheritance import InheritanceResolver
+from utils.animation import FORMATS, animation_output
+from utils.atlas import Atlas
+from utils.render import Output, add_workers_argument, caches, collect_all, group_duplicates, render_all
 
 DATA_FOLDER = Path("data")
 
 output_folder = Path("output/item_animations")
-output_folder.mkdir(parents=True, exist_ok=True)
-for file in output_folder.iterdir():
-    file.unlink()
-
-aggergated_file = Path("clean/aggregated.xml")
-aggregated_xml: etree._ElementTree = etree.parse(aggergated_file, None)
-
-manager = TileManager.from_aggregated_xml(DATA_FOLDER, aggregated_xml)
-
-for source, item in manager.iterate_elements(aggregated_xml, "item"):
-    animation = item.get("animation", "single")
-    icon = item.get("icon", None)
-    if icon is None:
-        print(f"skipping {item.get("id", None)}")
-        continue
-    frames, offsets = manager.get_tile_animation(icon, animation)
-    formatted = manager.format_animation(frames, offsets)
-    
-    for i, frame in enumerate(formatted):
-        file = output_folder / f'{item.get("id", None)}_{i}.png'
-        frame.save(file)
+atlas_folder = Path("output/atlas")
+
+
+def render_item(state: tuple[TileManager, str, bool], job: tuple[tuple[str, ...], tuple[str, str]]) -> list[Output]:
+    "Render the animation shared by the items of `job`, saved for the first one and linked for the others"
+    manager, output_format, use_shared_palette = state
+    (item_id, *duplicates), (icon, animation) = job
+    formatted = manager.render_animation(icon, animation)
+    if output_format != "png":
+        output = animation_output(output_folder / item_id, formatted, output_format, use_shared_palette, name=item_id)
+        return [output._replace(links=tuple(output_folder / (duplicate + FORMATS[output_format]) for duplicate in duplicates))]
+    return [
+        Output(
+            output_folder / f'{item_id}_{i}.png', frame, name=item_id, frame=i,
+            links=tuple(output_folder / f'{duplicate}_{i}.png' for duplicate in duplicates),
+        )
+        for i, frame in enumerate(formatted)
+    ]
+
+
+def main():
+    argparser = argparse.ArgumentParser(description=__doc__)
+    add_workers_argument(argparser)
+    argparser.add_argument(
+        "--atlas", action="store_true",
+        help="Pack every frame into a few sheets in output/atlas, with a JSON manifest, instead of one PNG per frame",
+    )
+    argparser.add_argument(
+        "--format", choices=["png", *FORMATS], default="png",
+        help="png: one PNG per frame (default), otherwise a single animated file per animation",
+    )
+    argparser.add_argument(
+        "--shared-palette", action="store_true",
+        help="Quantize the frames of each animation to a single palette (apng and gif)",
+    )
+    args = argparser.parse_args()
+    if args.atlas and args.format != "png":
+        argparser.error("--atlas packs individual frames, it can't be used with --format")
+
+    if not args.atlas:
+        output_folder.mkdir(parents=True, exist_ok=True)
+        for file in output_folder.iterdir():
+            file.unlink()
+
+    aggregated = cache.load()
+
+    manager = TileManager.from_aggregated_data(DATA_FOLDER, aggregated)
+
+    # item id -> (icon, animation), the last definition of an id wins
+    jobs: dict[str, tuple[str, str]] = {}
+    # Including everything inherited through `extends`
+    for source, item in InheritanceResolver(aggregated.index, "item").resolve_all():
+        animation = item.get("animation", "single")
+        icon = item.get("icon", None)
+        if icon is None:
+            print(f"skipping {item.get("id", None)}")
+            continue
+        jobs[item.get("id", None)] = (icon, animation)
+
+    # Items with the same animation of the same part of a tilesheet are only rendered once
+    unique_jobs = group_duplicates(jobs, lambda job: manager.animation_key(*job))
+
+    state = (manager, args.format, args.shared_palette)
+    if args.atlas:
+        stats, outputs = collect_all(
+            unique_jobs, lambda job: manager.tiles[job[1][0]].sheet.source_file, render_item, state,
+            workers=args.workers, get_caches=caches,
+        )
+        atlas = Atlas()
+        for output in outputs:
+            atlas.add(output.name, output.frame, output.image)
+        for (item_id, *duplicates), _ in unique_jobs:
+            for duplicate in duplicates:
+                atlas.alias(duplicate, item_id)
+        print(f"Packed {len(outputs)} frames into {atlas.save(atlas_folder, 'item_animations')} sheets")
+    else:
+        stats = render_all(
+            unique_jobs, lambda job: manager.tiles[job[1][0]].sheet.source_file, render_item, state,
+            workers=args.workers, get_caches=caches,
+        )
+    print(f"{len(jobs) - len(unique_jobs)} of {len(jobs)} animations are identical to another one")
+    print(stats)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,104 +1,41 @@
 "Parses all Tiles and their Tilesheets, then find all icons used by items and extract them individually"
 
-from lxml import etree
 from pathlib import Path
-from dataclasses import dataclass
+from functools import cache as cache_function, partial
 from PIL import Image
 from subprocess import run
+import argparse
+
+from utils import cache
+from utils.cache import Element
+from utils.images import DEFAULT_IMAGE_BUDGET, LRUCache, Tile, TileManager, Tilesheet, image_size, open_image, tint
+from utils.index import DataIndex
+from utils.inheritance import InheritanceResolver
+from utils.atlas import Atlas
+from utils.render import Output, add_workers_argument, collect_all, group_duplicates, render_all
 
 DATA_FOLDER = Path("data")
 
-@dataclass
-class Frame:
-    frame: int
-    x: int
-    y: int
-    width: int | None
-    height: int | None
-    offsetX: int | None
-    offsetY: int | None
-
-@dataclass
-class Tilesheet:
-    id: str
-    source_file: Path
-    width: int
-    height: int
-    offsetX: int
-    offsetY: int
-    frames: list[Frame]
-
-@dataclass
-class Tile:
-    id: str
-    source_file: Path
-    sheet: Tilesheet
-    x: int
-    y: int
-
-
-cached = Path("clean/aggregated.xml")
 output_folder = Path("output/items")
+atlas_folder = Path("output/atlas")
 
-output_folder.mkdir(parents=True, exist_ok=True)
-
-tree: etree._ElementTree = etree.parse(cached, None)
 
-magick = False
-try:
-    if run(['magick', '-version'], capture_output=True).returncode == 0:
-        magick = True
-except Exception:
-    print("ImageMagick not found")
+def has_magick() -> bool:
+    try:
+        if run(['magick', '-version'], capture_output=True).returncode == 0:
+            return True
+    except Exception:
+        pass
+    print("ImageMagick not found, tinting with Pillow instead")
+    return False
 
 
 def show(element):
     'utils function for debugging'
-    print(etree.tostring(element, pretty_print=True).decode())  # type: ignore
-
-# Each element in the data list corresponds to one file's root <data> or equivalent
-data: list[etree._Element] = tree.findall('./', None)
-
-# NOTE: THE OUTPUT DOES NOT INCLUDES ANYTHING INHERITED FROM EXTENDING
-
-items: list[etree._Element] = [item for root in data for item in root.findall("item", None)]
-
-
-def _get_default(frames, frame_index, field, default):
-    'Find the `equals=` frame and grab its field, or return a default value'
-    return next((getattr(frame, field) for frame in frames if frame.frame == frame_index), default)
-
-
-_frame_defaults = {
-    "frame": 0,
-    "x": 0,
-    "y": 0,
-    "width": None,  # "Inherited" from the <sheet>
-    "height": None,
-    "offsetX": None,
-    "offsetY": None,    
-}
-
-def parse_frames(sheet: etree._Element) -> list[Frame]:
-    "Parse <image> tags inside of a <sheet>. Returns an empty list if it has none."
-    frames = []
-    frame: etree._Element
-    for frame in sheet.findall("image", None):
-        fields = {}
-        equals = frame.get("equals", None)
-        for field, default in _frame_defaults.items():
-            if equals is not None:
-                default = _get_default(frames, int(equals), field, default)
-            result = frame.get(field, default)
-
-            fields[field] = int(result) if result is not None else None
-        frames.append(Frame(**fields))
+    print(element.to_string())
 
-    frames.sort(key = lambda frame: frame.frame)
-    return frames
 
-
-def create_tilesheet(path: Path, sheet: etree._Element | None) -> Tilesheet:
+def create_tilesheet(path: Path, sheet: Element | None) -> Tilesheet:
     "Parses a <sheet> element, or a reference to a tilesheet which does not have an explicitly <sheet> tag (using default values)"
     if sheet is None:
         return Tilesheet(
@@ -118,25 +55,26 @@ def create_tilesheet(path: Path, sheet: etree._Element | None) -> Tilesheet:
             height=int(sheet.get("height", 16)),
             offsetX=int(sheet.get("offsetX", 0)),
             offsetY=int(sheet.get("offsetY", 0)),
-            frames=parse_frames(sheet),
+            frames=TileManager.parse_frames(sheet),
         )
         for frame in tilesheet.frames:
-            for field in ('width', 'height', 'offsetX', 'offsetY'):
-                if getattr(frame, field) is None:  # Set defaults for all Frames
-                    setattr(frame, field, getattr(tilesheet, field))
+            for attribute in ('width', 'height', 'offsetX', 'offsetY'):
+                if getattr(frame, attribute) is None:  # Set defaults for all Frames
+                    setattr(frame, attribute, getattr(tilesheet, attribute))
         return tilesheet
 
 
-tilesheets: dict[Path, Tilesheet] = {}
+def load_tilesheets(index: DataIndex) -> dict[Path, Tilesheet]:
+    tilesheets: dict[Path, Tilesheet] = {}
 
-for source in data:
-    sheet: etree._Element
+    sheet: Element
     # Register all Tilesheets with an explicit definition (with non-default settings such as setting its width, height or frames)
-    for sheet in source.findall("tilesheet", None):
-        sheet_long_id = Path(source.get("source", None)).parent / sheet.get("id", None)
+    for source, sheet in index.by_tag("tilesheet"):
+        sheet_long_id = source.parent / sheet.get("id", None)
         # In some cases, the ID may differ from the actual file path, if `sheet='*.png'` is present
-        sheet_path = Path(source.get("source", None)).parent / sheet.get("sheet", sheet.get("id", None))
+        sheet_path = source.parent / sheet.get("sheet", sheet.get("id", None))
         tilesheets[sheet_long_id] = create_tilesheet(sheet_path, sheet)
+    return tilesheets
 
 # ----------------
 
@@ -145,10 +83,10 @@ def parse_source_sheet(source_path: Path, sheet_id: str) -> Path:
     if '{' in sheet_id:
         return Path(sheet_id.replace('{', '').replace('}', ''))
     else:
-        return Path(source_path).parent / source_sheet
+        return Path(source_path).parent / sheet_id
 
 
-def create_tile(sheet: Tilesheet, tile: etree._Element) -> Tile:
+def create_tile(source_file: Path, sheet: Tilesheet, tile: Element) -> Tile:
     "Parses a <tile> element"
     return Tile(
         id=tile.get("id", None),
@@ -158,14 +96,14 @@ def create_tile(sheet: Tilesheet, tile: etree._Element) -> Tile:
         y=int(tile.get("y", 0)),
     )
 
-tiles: dict[str, Tile] = {}
-_equal_tiles: dict[str, str] = {}
 
-for source in data:
-    tile: etree._Element
-    source_file = Path(source.get("source", None))
-    # Load all tiles
-    for tile in source.findall("tile", None):
+def load_tiles(index: DataIndex, tilesheets: dict[Path, Tilesheet]) -> dict[str, Tile]:
+    "Load all tiles, registering the tilesheets without a <tilesheet> definition (with default settings)"
+    tiles: dict[str, Tile] = {}
+    _equal_tiles: dict[str, str] = {}
+
+    tile: Element
+    for source_file, tile in index.by_tag("tile"):
         if (eq := tile.get("equals", None)) is not None:
             _equal_tiles[tile.get("id", None)] = eq
             continue  # Handled later
@@ -179,40 +117,44 @@ for source in data:
             print(f"Creating sheet with default settings: {sheet_path}")
             tilesheets[sheet_path] = create_tilesheet(sheet_path, None)
         # Parse the tile from the tilesheet
-        tiles[tile.get("id", None)] = create_tile(tilesheets[sheet_path], tile)
-
+        tiles[tile.get("id", None)] = create_tile(source_file, tilesheets[sheet_path], tile)
 
-for equal_tile, source_tile in _equal_tiles.items():
-    if source_tile == 'empty':
-        continue
-    tiles[equal_tile] = tiles[source_tile]
+    for equal_tile, source_tile in _equal_tiles.items():
+        if source_tile == 'empty':
+            continue
+        tiles[equal_tile] = tiles[source_tile]
+    return tiles
 
-del _equal_tiles
 
+# Decoded tilesheets, shared by every icon using them
+sheet_images: LRUCache[Path, Image.Image] = LRUCache(DEFAULT_IMAGE_BUDGET, image_size)
 
 
-def load_tile_image(tile: Tile) -> Image.Image:
-    # TODO SUPPORT OFFSET
-    # TODO CREATE GIF?
+def tile_rect(tile: Tile, sheet_width: int) -> tuple[int, int, int, int]:
+    "Rectangle (left, top, right, bottom) of the tile in its tilesheet image, which is `sheet_width` pixels wide"
     tilesheet = tile.sheet
-    # TODO Might want to 'cache' the image?
-    image = Image.open(DATA_FOLDER / tilesheet.source_file)
-
-    n_cols = image.width // tilesheet.width
+    n_cols = sheet_width // tilesheet.width
     # n_rows = image.height // tilesheet.height
     if tilesheet.frames:
         position = tile.x + tile.y * n_cols
-        frame = next((frame for frame in tilesheet.frames if frame.frame == position))
+        frame = tilesheet.frame_index[position]
         new_y, new_x = divmod(frame.x + frame.y * n_cols, n_cols)
     else:
         new_y, new_x = divmod(tile.x + tile.y * n_cols, n_cols)
 
-    return image.crop((
+    return (
         new_x * tilesheet.width,
         new_y * tilesheet.height,
         (new_x + 1) * tilesheet.width,
         (new_y + 1) * tilesheet.height,
-    ))
+    )
+
+
+def load_tile_image(tile: Tile) -> Image.Image:
+    # TODO SUPPORT OFFSET
+    # TODO CREATE GIF?
+    image = sheet_images.get(DATA_FOLDER / tile.sheet.source_file, open_image)
+    return image.crop(tile_rect(tile, image.width))
 
 
 def hex_to_rgb(value):
@@ -222,9 +164,61 @@ def hex_to_rgb(value):
     return list(int(value[i:i + lv // 3], 16) / 255 for i in range(0, lv, lv // 3))
 
 
-for source_data in data:
-    item: etree._Element
-    for item in source_data.findall("./item", None):
+def tint_with_magick(color_rgb: list[float], out_file: Path):
+    run(['magick', out_file, '-channel', 'Red', '-evaluate', 'Multiply', str(color_rgb[0]), '-channel', 'Green', '-evaluate', 'Multiply', str(color_rgb[1]), '-channel', 'Blue', '-evaluate', 'Multiply', str(color_rgb[2]), out_file])
+
+
+def render_icon(
+        state: tuple[dict[str, Tile], bool], job: tuple[tuple[str, ...], tuple[str, tuple[float, ...] | None]],
+) -> list[Output]:
+    "Render the icon shared by the items of `job`, saved for the first one and linked for the others"
+    tiles, magick = state
+    (item_id, *duplicates), (item_icon, color_rgb) = job
+    icon = load_tile_image(tiles[item_icon])
+    out_file = output_folder / (item_id + '.png')
+    links = tuple(output_folder / (duplicate + '.png') for duplicate in duplicates)
+    if color_rgb is None:
+        return [Output(out_file, icon, name=item_id, links=links)]
+    if magick:
+        # Tinted in place once saved
+        return [Output(out_file, icon, partial(tint_with_magick, color_rgb), name=item_id, links=links)]
+    return [Output(out_file, tint(icon, color_rgb), name=item_id, links=links)]
+
+
+def caches(state) -> dict[str, LRUCache]:
+    return {"tilesheets": sheet_images}
+
+
+def main():
+    argparser = argparse.ArgumentParser(description=__doc__)
+    add_workers_argument(argparser)
+    argparser.add_argument(
+        "--magick", action="store_true",
+        help="Tint the icons with ImageMagick (if it is installed) instead of Pillow, running it once per tinted icon",
+    )
+    argparser.add_argument(
+        "--atlas", action="store_true",
+        help="Pack every icon into a few sheets in output/atlas, with a JSON manifest, instead of one PNG per icon",
+    )
+    args = argparser.parse_args()
+
+    if args.atlas and args.magick:
+        argparser.error("--magick only works on saved files, it can't be used with --atlas")
+    if not args.atlas:
+        output_folder.mkdir(parents=True, exist_ok=True)
+
+    aggregated = cache.load()
+    magick = args.magick and has_magick()
+
+    # All definitions, by tag and by id
+    index = aggregated.index
+    tiles = load_tiles(index, load_tilesheets(index))
+
+    # item id -> (icon, color), the last definition of an id wins
+    jobs: dict[str, tuple[str, tuple[float, ...] | None]] = {}
+    item: Element
+    # Items with everything they inherit through `extends`
+    for _, item in InheritanceResolver(index, "item").resolve_all():
         # show(item)
         # print(tiles[item_icon])
         item_id = item.get("id", None)
@@ -233,16 +227,51 @@ for source_data in data:
         item_colorscale = item.get("colorScale", None)
         if item_colorscale is not None:
             item_colorscale = float(item_colorscale)
-        # TODO SUPPORT OTHER PROPERTIES (COLOR, COLORSCALE, EXTENDS, etc)
+        # TODO SUPPORT OTHER PROPERTIES
         if item_icon is None:
             continue
-        icon = load_tile_image(tiles[item_icon])
-        out_file = output_folder / (item_id + '.png')
-        icon.save(out_file)
-        if magick is not True:
-            continue
+        color_rgb = None
         if item_color is not None:
             color_rgb = hex_to_rgb(item_color)
             if item_colorscale is not None:
                 color_rgb = [i * item_colorscale for i in color_rgb]
-            run(['magick', out_file, '-channel', 'Red', '-evaluate', 'Multiply', str(color_rgb[0]), '-channel', 'Green', '-evaluate', 'Multiply', str(color_rgb[1]), '-channel', 'Blue', '-evaluate', 'Multiply', str(color_rgb[2]), out_file])
\ No newline at end of file
+            color_rgb = tuple(color_rgb)
+        jobs[item_id] = (item_icon, color_rgb)
+
+    @cache_function
+    def sheet_width(source_file: Path) -> int:
+        # Only reads the header, the image isn't decoded
+        with Image.open(DATA_FOLDER / source_file) as image:
+            return image.width
+
+    def content(job: tuple[str, tuple[float, ...] | None]):
+        "Same rectangle of the same tilesheet image (even through different Tilesheets or Tiles), with the same tint"
+        tile = tiles[job[0]]
+        source_file = tile.sheet.source_file
+        return source_file, tile_rect(tile, sheet_width(source_file)), job[1]
+
+    unique_jobs = group_duplicates(jobs, content)
+
+    if args.atlas:
+        stats, outputs = collect_all(
+            unique_jobs, lambda job: tiles[job[1][0]].sheet.source_file, render_icon, (tiles, magick),
+            workers=args.workers, get_caches=caches,
+        )
+        atlas = Atlas()
+        for output in outputs:
+            atlas.add(output.name, output.frame, output.image)
+        for (item_id, *duplicates), _ in unique_jobs:
+            for duplicate in duplicates:
+                atlas.alias(duplicate, item_id)
+        print(f"Packed {len(outputs)} icons into {atlas.save(atlas_folder, 'item_icons')} sheets")
+    else:
+        stats = render_all(
+            unique_jobs, lambda job: tiles[job[1][0]].sheet.source_file, render_icon, (tiles, magick),
+            workers=args.workers, get_caches=caches,
+        )
+    print(f"{len(jobs) - len(unique_jobs)} of {len(jobs)} icons are identical to another one")
+    print(stats)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,189 +1,178 @@
 "Extracts all <item> definitions, selecting a subset of their properties and relationships with other types of data"
 
+import argparse
+import hashlib
 import json
-from lxml import etree
 from pathlib import Path
 
-cached = Path("clean/aggregated.xml")
-output_folder = Path("output/items")
+from utils import cache
+from utils.cache import Element
+from utils.extraction import ExtractionPlan, common_properties, composite_properties
+from utils.inheritance import InheritanceResolver
+from utils.lang import LanguageTable
+from utils.relations import build as build_relations
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Exported to output/items, the other locales each to their own output/<locale>/items
+DEFAULT_LOCALE = "en_US"
+
+argparser = argparse.ArgumentParser(description=__doc__)
+argparser.add_argument(
+    "--format", choices=["files", "jsonl", "json"], default="files",
+    help="files: one output/items/<id>.json per item (default), "
+    "jsonl: all items in output/items.jsonl, json: a single object keyed by id in output/items.json",
+)
+argparser.add_argument(
+    "--force", action="store_true",
+    help="Rewrite every item, instead of only the ones that changed since the last run (see output/items.<format>.manifest.json)",
+)
+argparser.add_argument(
+    "--locales", nargs="+", default=[DEFAULT_LOCALE],
+    help=f"Locales to export the item names in (default: {DEFAULT_LOCALE}). "
+    f"{DEFAULT_LOCALE} goes to output/items, every other locale to its own output/<locale>/items directory "
+    "(with its manifest and delta next to it)",
+)
+args = argparser.parse_args()
 
-output_folder.mkdir(parents=True, exist_ok=True)
+output_folder = Path("output/items")
 
-tree: etree._ElementTree = etree.parse(cached, None)
+aggregated = cache.load()
 
 def show(element):
     'utils function for debugging'
-    print(etree.tostring(element, pretty_print=True).decode())  # type: ignore
-
-# Each element in the data list corresponds to one file's root <data> or equivalent
-data: list[etree._Element] = tree.findall('./', None)
-
-# NOTE: THE OUTPUT DOES NOT INCLUDES ANYTHING INHERITED FROM EXTENDING
-
-items: list[etree._Element] = [item for root in data for item in root.findall("item", None)]
-
-recipes: list[etree._Element] = [recipe for root in data for recipe in root.findall("recipe", None)]
-quests: list[etree._Element] = [quest for root in data for quest in root.findall("quest", None)]
-enemies: list[etree._Element] = [enemy for root in data for enemy in root.findall("enemy", None)]
-
-LANG = {}
-for root in data:
-    for lang in root.findall("lang", None):
-        lang_map = LANG.setdefault(lang.get("id", None), {})
-        for section in lang.findall("section", None):
-            for text in section.findall("text", None):
-                text_string = text.text.strip()
-                for connector in ['>', '.']:
-                    text_id = section.get("id", None) + connector + text.get("id", None)
-                    lang_map[text_id] = text_string
-
-# item id -> list of enemies
-looted_from: dict[str, list[str]] = {}
-for enemy in enemies:
-    loot_items: list[etree._Element] = [*enemy.findall("./lootSet/loot", None), *enemy.findall("./loot", None)]
-    for item in loot_items:
-        if (item_id := item.get("id", None)) is not None:
-            looted_from.setdefault(item_id, []).append(enemy.get("id", None))
-
+    print(element.to_string())
 
-used_for_quests: dict[str, list[str]] = {}
-for quest in quests:
-    required_items: list[etree._Element] = quest.findall("./item", None)
-    for item in required_items:
-        used_for_quests.setdefault(item.get("id", None), []).append(quest.get("id", None))
+# All definitions, by tag and by id
+index = aggregated.index
 
+# Items with everything they inherit through `extends`
+items = list(InheritanceResolver(index, "item").resolve_all())
 
-created_from_recipes: dict[str, list[str]] = {}
-used_for_recipes: dict[str, list[str]] = {}
-for recipe in recipes:
-    required_items: list[etree._Element] = recipe.findall("./item", None)
-    creates: str = recipe.get("creates", None)
-    created_from_recipes.setdefault(creates, []).append(recipe.get("id", None))
-    for item in required_items:
-        used_for_recipes.setdefault(item.get("id", None), []).append(recipe.get("id", None))
+lang = LanguageTable.from_index(index, args.locales)
 
-# item id -> list of familiars that eat it
-familiars_eat: dict[str, list[str]] = {}
+# Keys of the names of all items, either from their `name` (with or without the section) or from their id
+item_name_keys: dict[str, tuple[str, ...]] = {
+    item.get("id", None): (
+        (item.get("name", None), f"item.names>{item.get("name", None)}")
+        if item.get("name", None) else (f"item.names>{item.get("id", None)}",)
+    )
+    for _, item in items
+}
 
-for item in items:
-    familiar = item.find("familiar", None)
-    if familiar is not None:
-        for food in item.findall("food", None):
-            familiars_eat.setdefault(food.get("id", None), []).append(item.get("id", None))
+# Relationships between items and the other definitions, e.g. which enemies drop an item
+relations = build_relations(index)
 
 
 # --------
-common_properties = [
-    "type",
-    "extends",
-    "slot",
-    "weight",
-    "droppable",
-    "cost",
-    "element",
-    "knockback",
-    "reflect",
-    "melee_range",
-    "range",
-    "damage",
-    "attack",
-    "cut",
-    "defense",
-    "block",
-    "mine",
-    "breakPower",
-    "durability",
-    "broken",
-    "repair",
-    "health",
-    "stamina",
-    "power",
-    "underwater",
-    "canJump",
-    "with",
-    "unequip",
-    "equipOn",
-    "hpSteal",
-    "group",
-]
-composite_properties = [
-    ["flight", "height"],
-    ["flight", "speed"],
-    ["flight", "cost"],
-    ["use", "slot"],
-    ["projectile", "speed"],
-    ["projectile", "hitEffect", "id"],
-    ["projectile", "breakPower"],
-    ["hitEffect", "id"],
-    ["light", "tile"],
-    ["familiar", "id"],
-    ["stat", "id"],
-    ["stat", "value"],
-    ["stat", "time"],
-    ["stat", "max"],
-    ["equipCost", "health"],
-    ["equipCost", "stamina"],
-    ["equipCost", "storage"],
-    ["equipCost", "cost"],
-]
-
-def get_composite(node: etree._Element, path: list[str]) -> list[str]:
-    if len(path) > 1:
-        results = []
-        for child in node.findall(path[0], None):
-            results.extend(get_composite(child, path[1:]))
-        return results
+extraction_plan = ExtractionPlan(common_properties, composite_properties)
+
+def item_record(source: Path, item: Element) -> dict:
+    "The output for one <item> definition"
+    item_id = item.get("id", None)
+    assert isinstance(item_id, str)
+    # Still missing: effect and alike? not sure tbh
+    result = {
+        "source": source.as_posix(),
+        "id": item_id,
+        "name": item_id,  # Replaced by the translated name of each locale, if any
+        **extraction_plan.extract(item),
+    }
+    special_connections = {
+        "looted_from": relations.sources("loot", item_id),
+        "quest_requires": relations.sources("quest_requires", item_id),
+        "familiar_food": relations.sources("familiar_food", item_id),
+        "recipe_creates": relations.sources("recipe_creates", item_id),
+        "ingredient": relations.sources("ingredient", item_id),
+    }
+    if special_connections := {key: value for key, value in special_connections.items() if value}:
+        result["special_connections"] = special_connections
+    return result
+
+
+_encoder = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"))
+
+def dumps(record) -> bytes:
+    "Compact JSON, using orjson when it is installed"
+    if orjson is not None:
+        return orjson.dumps(record)
+    return _encoder.encode(record).encode("UTF-8")
+
+
+def record_hash(record: dict) -> str:
+    "Stable hash of a record's content, independent of the output format"
+    return hashlib.sha256(json.dumps(record, sort_keys=True).encode("UTF-8")).hexdigest()
+
+
+def load_manifest(manifest_file: Path) -> dict[str, str]:
+    "Record hashes of the previous run, as {item id: hash}"
+    try:
+        return json.loads(manifest_file.read_text("UTF-8"))
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def export(records: dict[str, dict], folder: Path, output_format: str, force: bool = False):
+    """Write the records in the requested format, then compare them to the previous run.
+    Only the records that were added or changed are rewritten (in the `files` format),
+    and the difference is saved next to the output, e.g. for syncing only the delta to the wiki.
+    Each format has its own manifest, as each one is a different output that may be out of date.
+    `force` rewrites every record, but the difference is still computed."""
+    manifest_file = folder.with_name(f"{folder.name}.{output_format}.manifest.json")
+    delta_file = folder.with_name(f"{folder.name}.{output_format}.delta.json")
+
+    hashes = {item_id: record_hash(record) for item_id, record in records.items()}
+    previous = load_manifest(manifest_file)
+    added = sorted(hashes.keys() - previous.keys())
+    removed = sorted(previous.keys() - hashes.keys())
+    changed = sorted(item_id for item_id in hashes.keys() & previous.keys() if hashes[item_id] != previous[item_id])
+
+    if output_format == "files":
+        # One file per item
+        folder.mkdir(parents=True, exist_ok=True)
+        written = 0
+        for item_id, record in records.items():
+            file_path = folder / (item_id + '.json')
+            if not force and item_id in previous and hashes[item_id] == previous[item_id] and file_path.exists():
+                continue
+            with file_path.open('w') as file:
+                json.dump(record, file, indent=4)
+            written += 1
+        for item_id in removed:
+            (folder / (item_id + '.json')).unlink(missing_ok=True)
+        print(f"Wrote {written} item files, skipped {len(records) - written} unchanged")
+    elif output_format == "jsonl":
+        # One line per item, streamed into a single file
+        with folder.with_name(folder.name + ".jsonl").open('wb', buffering=1024 * 1024) as file:
+            for record in records.values():
+                file.write(dumps(record) + b"\n")
     else:
-        return [node.get(path[0], None)]
-
-for source_data in data:
-    item: etree._Element
-    for item in source_data.findall("./item", None):
-        item_id = item.get("id", None)
-        if item.get('name', None):
-            try:
-                item_name = LANG["en_US"][item.get("name", None)]
-            except KeyError:
-                item_name = LANG["en_US"][f"item.names>{item.get("name", None)}"]
-        else:
-            try:
-                item_name = LANG["en_US"][f"item.names>{item_id}"]
-            except KeyError:
-                print(f"Failed to get name for {item_id}")
-                item_name = item_id
-        assert isinstance(item_id, str)
-        # Still missing: effect and alike? not sure tbh
-        result = {
-            "source": source_data.get("source", None),
-            "id": item_id,
-            "name": item_name,
-            **{prop: item.get(prop, None) for prop in common_properties},
-            **{
-                '_'.join(composite_path): get_composite(item, composite_path)
-                for composite_path in composite_properties
-            },
-            "special_connections": {
-                "looted_from": looted_from.get(item_id),
-                "quest_requires": used_for_quests.get(item_id),
-                "familiar_food": familiars_eat.get(item_id),
-                "recipe_creates": created_from_recipes.get(item_id),
-                "ingredient": used_for_recipes.get(item_id),
-            },
-        }
-
-        for key, val in list(result.items()):
-            if isinstance(val, list):
-                val = list(filter(None, val))
-                if len(val) == 1:
-                    val = val[0]
-                    result[key] = val
-
-            if isinstance(val, dict):
-                for inner_key, inner_val in list(val.items()):
-                    if not inner_val:
-                        del val[inner_key]
-            if not val:
-                del result[key]
-
-        with (output_folder / (item_id + '.json')).open('w') as file:
-            json.dump(result, file, indent=4)
+        # A single object, keyed by id
+        with folder.with_name(folder.name + ".json").open('wb') as file:
+            file.write(dumps(records))
+
+    delta_file.write_text(json.dumps({"added": added, "removed": removed, "changed": changed}, indent=4), "UTF-8")
+    manifest_file.write_text(json.dumps(hashes, indent=0, sort_keys=True), "UTF-8")
+    print(f"{folder}: {len(added)} added, {len(removed)} removed, {len(changed)} changed")
+
+
+# The last definition wins, e.g. for items overridden by mods
+records = {record["id"]: record for record in (item_record(source, item) for source, item in items)}
+
+# Records and relationships are built once, only the names differ between locales
+for locale in args.locales:
+    names = lang.resolve(locale, item_name_keys)
+    for item_id, name in names.items():
+        if not name:
+            print(f"Failed to get {locale} name for {item_id}")
+    localized = {
+        item_id: {**record, "name": names[item_id]} if names[item_id] else record
+        for item_id, record in records.items()
+    }
+    # Each locale in its own directory, next to the default one, so that its records, manifest and delta
+    # are never mixed with those of another locale (or with the icons, also in output/items)
+    locale_folder = output_folder if locale == DEFAULT_LOCALE else output_folder.parent / locale / output_folder.name
+    export(localized, locale_folder, args.format, args.force)
@@ -4,6 +4,8 @@ adding the source path into the XML and wrapping around files that are included
 import pathlib
 from lxml import etree
 
+from utils import cache
+
 folder = pathlib.Path("clean")
 mods_cache_file = folder / "mods.xml"
 data_cache_file = folder / "aggregated.xml"
@@ -72,3 +74,6 @@ final_tree_mods.write(mods_cache_file)
 
 final_tree_data: etree._ElementTree = aggregated_data.getroottree()
 final_tree_data.write(data_cache_file)
+
+# Fast-loading version used by all other scripts
+cache.build(data_cache_file)
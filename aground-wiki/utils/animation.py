@@ -0,0 +1,83 @@
+"""Encoding of animation frames (e.g. from `TileManager.format_animation`) into a single animated APNG, WebP or GIF file,
+in place of one PNG per frame"""
+
+from pathlib import Path
+
+from PIL import Image
+
+from utils.render import Output
+
+# format -> file extension
+FORMATS: dict[str, str] = {
+    "apng": ".png",
+    "webp": ".webp",
+    "gif": ".gif",
+}
+
+# Milliseconds per frame (10 frames per second)
+FRAME_DURATION = 100
+
+
+def shared_palette(frames: list[Image.Image], colors: int = 256) -> tuple[list[Image.Image], int | None]:
+    """Quantize all frames at once, so that they use the same palette (and don't flicker between colors):
+    the frames are placed side by side, the montage is quantized, then cut back into frames.
+    Transparency is reduced to fully transparent / fully opaque (as in GIFs), returns the transparent index if any."""
+    width = max(frame.width for frame in frames)
+    height = max(frame.height for frame in frames)
+    montage = Image.new("RGBA", (width * len(frames), height), 0)
+    for i, frame in enumerate(frames):
+        montage.paste(frame.convert("RGBA"), (i * width, 0))
+
+    # Every transparent pixel becomes the same color, so that they all get the same palette entry
+    alpha = montage.getchannel("A").point(lambda value: 255 if value >= 128 else 0)
+    montage.putalpha(alpha)
+    montage = Image.composite(montage, Image.new("RGBA", montage.size, 0), alpha)
+
+    quantized = montage.quantize(colors, method=Image.Quantize.FASTOCTREE, dither=Image.Dither.NONE)
+    palette = quantized.getpalette("RGBA") or []
+    transparent = [i for i in range(len(palette) // 4) if palette[i * 4 + 3] == 0]
+    transparency = transparent[0] if transparent else None
+    if len(transparent) > 1:
+        # Merge the transparent entries
+        table = list(range(256))
+        for i in transparent:
+            table[i] = transparent[0]
+        quantized = quantized.point(table)
+
+    return [
+        quantized.crop((i * width, 0, i * width + frame.width, frame.height))
+        for i, frame in enumerate(frames)
+    ], transparency
+
+
+def animation_output(
+        file: Path,
+        frames: list[Image.Image],
+        output_format: str,
+        use_shared_palette: bool = False,
+        duration: int = FRAME_DURATION,
+        name: str | None = None,
+) -> Output:
+    """An Output saving `frames` as a looping animation, in `file` followed by the extension of `output_format`
+    (appended, not replacing anything after a dot, as ids may contain some).
+    The shared palette only applies to APNG and GIF (WebP picks its own, for each frame)."""
+    file = file.with_name(file.name + FORMATS[output_format])
+    options: dict = {"duration": duration, "loop": 0}
+
+    if output_format == "webp":
+        frames = [frame.convert("RGBA") for frame in frames]
+        options["lossless"] = True
+    elif use_shared_palette:
+        frames, transparency = shared_palette(frames)
+        if transparency is not None:
+            options["transparency"] = transparency
+    else:
+        frames = [frame.convert("RGBA") for frame in frames]
+
+    if output_format == "gif":
+        # Clear each frame before drawing the next one, instead of drawing over it
+        options["disposal"] = 2
+    if len(frames) > 1:
+        options["save_all"] = True
+        options["append_images"] = frames[1:]
+    return Output(file, frames[0], name=name, options=options)
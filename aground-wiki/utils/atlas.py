@@ -0,0 +1,114 @@
+"""Packs many small images (icons, animation frames) into a few large sheets,
+with a JSON manifest giving the position of each frame of each id"""
+
+import json
+from dataclasses import asdict, dataclass
+from pathlib import Path
+
+from PIL import Image
+
+
+@dataclass
+class Placement:
+    # Index of the sheet, None if the frame is fully transparent (nothing to draw)
+    sheet: int | None
+    # Rectangle of the frame in the sheet
+    x: int
+    y: int
+    width: int
+    height: int
+    # Transparent borders are cut off: position of the rectangle in the original frame, and the frame's size
+    offsetX: int
+    offsetY: int
+    frameWidth: int
+    frameHeight: int
+
+
+class Atlas:
+    """Shelf packer: frames are sorted by height, then placed left to right in rows ("shelves"),
+    starting a new row when the current one is full and a new sheet when the current one is.
+    Ids with the same frames as another can be added as aliases (listed in the manifest's `aliases`)."""
+    def __init__(self, max_size: int = 2048, padding: int = 1):
+        self.max_size = max_size
+        # Space left between frames, so that they don't bleed into each other when scaled
+        self.padding = padding
+        # id -> frames, as (image trimmed of its transparent borders, its placement)
+        self.frames: dict[str, list[tuple[Image.Image | None, Placement]]] = {}
+        # id -> id with the same frames, which are only stored once
+        self.aliases: dict[str, str] = {}
+
+    def add(self, name: str, frame: int, image: Image.Image):
+        "Add the frame `frame` of the animation (or icon) `name`. Frames must be added in order."
+        image = image.convert("RGBA")
+        frames = self.frames.setdefault(name, [])
+        assert frame == len(frames), f"Frame {frame} of {name} added out of order"
+        bbox = image.getbbox()
+        if bbox is None:
+            frames.append((None, Placement(None, 0, 0, 0, 0, 0, 0, image.width, image.height)))
+            return
+        left, top, right, bottom = bbox
+        frames.append((
+            image.crop(bbox),
+            Placement(None, 0, 0, right - left, bottom - top, left, top, image.width, image.height),
+        ))
+
+    def alias(self, name: str, source: str):
+        "Make `name` refer to the frames of `source`"
+        self.aliases[name] = source
+
+    def pack(self) -> list[Image.Image]:
+        "Place every frame, and draw the sheets"
+        placed = [
+            (image, placement)
+            for frames in self.frames.values()
+            for image, placement in frames
+            if image is not None
+        ]
+        placed.sort(key=lambda entry: (entry[1].height, entry[1].width), reverse=True)
+
+        # (width, height) used by each sheet
+        sizes: list[list[int]] = []
+        x = y = shelf_height = 0
+        for _, placement in placed:
+            if not sizes or x + placement.width > self.max_size:
+                # New shelf
+                y += shelf_height + (self.padding if shelf_height else 0)
+                x = shelf_height = 0
+            if not sizes or y + placement.height > self.max_size:
+                # New sheet (a frame larger than the maximum size makes its sheet larger)
+                sizes.append([0, 0])
+                x = y = shelf_height = 0
+            placement.sheet = len(sizes) - 1
+            placement.x, placement.y = x, y
+            x += placement.width + self.padding
+            shelf_height = max(shelf_height, placement.height)
+            size = sizes[-1]
+            size[0] = max(size[0], placement.x + placement.width)
+            size[1] = max(size[1], placement.y + placement.height)
+
+        sheets = [Image.new("RGBA", (width, height), 0) for width, height in sizes]
+        for image, placement in placed:
+            assert placement.sheet is not None
+            sheets[placement.sheet].paste(image, (placement.x, placement.y))
+        return sheets
+
+    def save(self, folder: Path, name: str) -> int:
+        "Write the sheets as <name>_<i>.png, and the manifest as <name>.json. Returns the number of sheets."
+        folder.mkdir(parents=True, exist_ok=True)
+        # Sheets of a previous run, which may have needed more of them
+        for previous in folder.glob(f"{name}_*.png"):
+            previous.unlink()
+        sheets = self.pack()
+        sheet_files = [f"{name}_{i}.png" for i in range(len(sheets))]
+        for sheet, sheet_file in zip(sheets, sheet_files):
+            sheet.save(folder / sheet_file)
+        manifest = {
+            "sheets": sheet_files,
+            "frames": {
+                frame_id: [asdict(placement) for _, placement in frames]
+                for frame_id, frames in self.frames.items()
+            },
+            "aliases": self.aliases,
+        }
+        (folder / f"{name}.json").write_text(json.dumps(manifest, indent=1), "UTF-8")
+        return len(sheets)
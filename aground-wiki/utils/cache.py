@@ -0,0 +1,137 @@
+"""Fast-loading cache of the aggregated data, so that scripts don't have to parse the whole game XML on startup.
+
+`main.py` builds it next to `clean/aggregated.xml`; every script then calls `load()`,
+which rebuilds the cache by itself if it is missing or out of date.
+The cached elements support the subset of the lxml API used by the scripts (`get`, `find`, `findall`, ...)."""
+
+from dataclasses import dataclass, field
+from functools import lru_cache
+from pathlib import Path
+import hashlib
+import pickle
+import typing
+
+from lxml import etree
+
+from utils.index import DataIndex
+
+AGGREGATED_FILE = Path("clean/aggregated.xml")
+CACHE_FILE = Path("clean/aggregated.pickle")
+
+# Bump whenever the cached structure changes
+CACHE_VERSION = 2
+
+
+class Element:
+    "Lightweight, picklable equivalent of an lxml element"
+    __slots__ = ("tag", "attrib", "text", "children")
+
+    def __init__(self, tag: str, attrib: dict[str, str], text: str | None, children: list["Element"]):
+        self.tag = tag
+        self.attrib = attrib
+        self.text = text
+        self.children = children
+
+    def get(self, key: str, default: str | None = None) -> str | None:
+        return self.attrib.get(key, default)
+
+    def findall(self, path: str, namespaces: None = None) -> list["Element"]:
+        "Supports simple paths only: child tags separated by `/`, optionally starting with `./`"
+        elements = [self]
+        for tag in _split_path(path):
+            elements = [child for element in elements for child in element.children if tag is None or child.tag == tag]
+        return elements
+
+    def find(self, path: str, namespaces: None = None) -> "Element | None":
+        return next(iter(self.findall(path, namespaces)), None)
+
+    def iter(self, tag: str | None = None) -> typing.Generator["Element", None, None]:
+        "This element and all of its descendants, in document order"
+        stack = [self]
+        while stack:
+            element = stack.pop()
+            if tag is None or element.tag == tag:
+                yield element
+            stack.extend(reversed(element.children))
+
+    def __iter__(self):
+        return iter(self.children)
+
+    def __len__(self):
+        return len(self.children)
+
+    def __repr__(self):
+        return f"<Element {self.tag} {self.attrib}>"
+
+    def to_lxml(self) -> etree._Element:
+        element = etree.Element(self.tag, self.attrib, None)
+        element.text = self.text
+        for child in self.children:
+            element.append(child.to_lxml())
+        return element
+
+    def to_string(self) -> str:
+        return etree.tostring(self.to_lxml(), pretty_print=True).decode()  # type: ignore
+
+    @classmethod
+    def from_lxml(cls, element: etree._Element) -> "Element":
+        return cls(
+            element.tag,  # type: ignore
+            dict(element.attrib),
+            element.text,
+            # Skip comments and processing instructions
+            [cls.from_lxml(child) for child in element if isinstance(child.tag, str)],
+        )
+
+
+@lru_cache(maxsize=None)
+def _split_path(path: str) -> tuple[str | None, ...]:
+    if path.startswith("./"):
+        path = path[2:]
+    elif path == ".":
+        return ()
+    return tuple(None if tag in ("", "*") else tag for tag in path.split("/"))
+
+
+@dataclass
+class AggregatedData:
+    # One per source file: its root <data> (or equivalent), with a `source` attribute
+    roots: list[Element]
+    # All the top-level elements, e.g. every <item>, by tag and by id
+    index: DataIndex = field(default_factory=DataIndex)
+
+    @classmethod
+    def from_lxml(cls, aggregated: etree._Element) -> "AggregatedData":
+        roots = [Element.from_lxml(root) for root in aggregated if isinstance(root.tag, str)]
+        return cls(roots, DataIndex.build(roots))
+
+
+def file_hash(file: Path) -> str:
+    return hashlib.sha256(file.read_bytes()).hexdigest()
+
+
+def build(aggregated_file: Path = AGGREGATED_FILE, cache_file: Path = CACHE_FILE) -> AggregatedData:
+    "Parse the aggregated XML file and save it as a cache"
+    source_hash = file_hash(aggregated_file)
+    tree: etree._ElementTree = etree.parse(aggregated_file, None)
+    data = AggregatedData.from_lxml(tree.getroot())
+    with cache_file.open("wb") as file:
+        pickle.dump(
+            {"version": CACHE_VERSION, "source_hash": source_hash, "data": data},
+            file,
+            protocol=pickle.HIGHEST_PROTOCOL,
+        )
+    return data
+
+
+def load(aggregated_file: Path = AGGREGATED_FILE, cache_file: Path = CACHE_FILE) -> AggregatedData:
+    "Load the cache of the aggregated data, (re)building it if it does not match the aggregated XML file"
+    try:
+        with cache_file.open("rb") as file:
+            cached = pickle.load(file)
+        if cached["version"] == CACHE_VERSION and cached["source_hash"] == file_hash(aggregated_file):
+            return cached["data"]
+        print("Aggregated data cache is out of date, rebuilding it")
+    except (FileNotFoundError, pickle.UnpicklingError, EOFError, AttributeError, KeyError):
+        print("Aggregated data cache not found, building it")
+    return build(aggregated_file, cache_file)
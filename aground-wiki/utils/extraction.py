@@ -0,0 +1,117 @@
+"Extraction of a fixed set of properties from many similar elements (e.g. every <item>)"
+
+from collections import deque
+from dataclasses import dataclass, field
+
+from utils.cache import Element
+
+
+@dataclass
+class _PlanNode:
+    # (attribute, output key) read from the elements reaching this node
+    attributes: list[tuple[str, str]] = field(default_factory=list)
+    # child tag -> node
+    children: dict[str, "_PlanNode"] = field(default_factory=dict)
+
+
+class ExtractionPlan:
+    """Compiled list of properties to extract:
+    - attributes: read directly from the element, e.g. "weight"
+    - paths: attribute of (grand)children, e.g. ["projectile", "hitEffect", "id"] -> key "projectile_hitEffect_id"
+
+    Paths sharing a prefix are grouped into a tree, so each child (e.g. every <stat>) is visited once for all of them.
+    Empty values are left out: paths give a single value if only one is set, otherwise every value (in document order).
+    """
+    def __init__(self, attributes: list[str], paths: list[list[str]]):
+        self.attributes = attributes
+        self.keys = ['_'.join(path) for path in paths]
+        self.root = _PlanNode()
+        for path, key in zip(paths, self.keys):
+            node = self.root
+            for tag in path[:-1]:
+                node = node.children.setdefault(tag, _PlanNode())
+            node.attributes.append((path[-1], key))
+
+    def extract(self, element: Element) -> dict[str, str | list[str | None]]:
+        result: dict[str, str | list[str | None]] = {}
+        for attribute in self.attributes:
+            if value := element.get(attribute, None):
+                result[attribute] = value
+
+        values: dict[str, list[str | None]] = {key: [] for key in self.keys}
+        # Breadth-first, so that values are in the same order as nested loops over each path
+        queue = deque([(element, self.root)])
+        while queue:
+            parent, node = queue.popleft()
+            for child in parent.children:
+                if (child_node := node.children.get(child.tag)) is None:
+                    continue
+                for attribute, key in child_node.attributes:
+                    values[key].append(child.get(attribute, None))
+                if child_node.children:
+                    queue.append((child, child_node))
+
+        for key in self.keys:
+            present = [value for value in values[key] if value]
+            if len(present) == 1:
+                result[key] = present[0]
+            elif present:
+                # Every value is kept so that lists of the same element (e.g. stat_id and stat_value) stay aligned
+                result[key] = values[key]
+        return result
+
+
+# Properties of <item> definitions exported by items.py
+common_properties = [
+    "type",
+    "extends",
+    "slot",
+    "weight",
+    "droppable",
+    "cost",
+    "element",
+    "knockback",
+    "reflect",
+    "melee_range",
+    "range",
+    "damage",
+    "attack",
+    "cut",
+    "defense",
+    "block",
+    "mine",
+    "breakPower",
+    "durability",
+    "broken",
+    "repair",
+    "health",
+    "stamina",
+    "power",
+    "underwater",
+    "canJump",
+    "with",
+    "unequip",
+    "equipOn",
+    "hpSteal",
+    "group",
+]
+composite_properties = [
+    ["flight", "height"],
+    ["flight", "speed"],
+    ["flight", "cost"],
+    ["use", "slot"],
+    ["projectile", "speed"],
+    ["projectile", "hitEffect", "id"],
+    ["projectile", "breakPower"],
+    ["hitEffect", "id"],
+    ["light", "tile"],
+    ["familiar", "id"],
+    ["stat", "id"],
+    ["stat", "value"],
+    ["stat", "time"],
+    ["stat", "max"],
+    ["equipCost", "health"],
+    ["equipCost", "stamina"],
+    ["equipCost", "storage"],
+    ["equipCost", "cost"],
+]
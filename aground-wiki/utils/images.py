@@ -1,9 +1,17 @@
 "Utility classes for parsing tile animations"
-from lxml import etree
+import typing
+from collections import OrderedDict
 from pathlib import Path
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from PIL import Image
 
+from utils.cache import AggregatedData, Element
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 @dataclass
 class Frame:
     frame: int
@@ -23,6 +31,13 @@ class Tilesheet:
     offsetX: int
     offsetY: int
     frames: list[Frame]
+    # frame index -> Frame (the first one defined, if it is defined several times)
+    frame_index: dict[int, Frame] = field(init=False)
+
+    def __post_init__(self):
+        self.frame_index = {}
+        for frame in self.frames:
+            self.frame_index.setdefault(frame.frame, frame)
 
 @dataclass
 class Tile:
@@ -42,10 +57,6 @@ class Animation:
     offsetY: int | None
 
 
-def _get_default(frames, frame_index, field, default):
-    'Find the `equals=` frame and grab its field, or return a default value'
-    return next((getattr(frame, field) for frame in frames if frame.frame == frame_index), default)
-
 _frame_defaults = {
     "frame": 0,
     "x": 0,
@@ -56,15 +67,144 @@ _frame_defaults = {
     "offsetY": None,    
 }
 
+K = typing.TypeVar("K")
+V = typing.TypeVar("V")
+
+
+class LRUCache(typing.Generic[K, V]):
+    """Keeps values up to a total `budget`, as measured by `cost` (1 per value by default).
+    When over budget, the least recently used values are evicted first."""
+    def __init__(self, budget: int, cost: typing.Callable[[V], int] = lambda value: 1):
+        self.budget = budget
+        self.cost = cost
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._values: OrderedDict[K, tuple[V, int]] = OrderedDict()
+
+    def get(self, key: K, load: typing.Callable[[K], V]) -> V:
+        "The value of `key`, calling `load(key)` if it is not cached yet"
+        if key in self._values:
+            self.hits += 1
+            self._values.move_to_end(key)
+            return self._values[key][0]
+        self.misses += 1
+        value = load(key)
+        self.put(key, value)
+        return value
+
+    def put(self, key: K, value: V):
+        if key in self._values:
+            self.size -= self._values.pop(key)[1]
+        cost = self.cost(value)
+        self._values[key] = (value, cost)
+        self.size += cost
+        # The newest value is always kept, even if it alone is over budget
+        while self.size > self.budget and len(self._values) > 1:
+            _, (_, evicted_cost) = self._values.popitem(last=False)
+            self.size -= evicted_cost
+            self.evictions += 1
+
+    def clear(self):
+        self._values.clear()
+        self.size = 0
+
+    def __contains__(self, key: K) -> bool:
+        return key in self._values
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+    def stats(self) -> str:
+        return f"{self.hits} hits, {self.misses} misses, {self.evictions} evictions, {len(self)} cached ({self.size} / {self.budget})"
+
+
+# Decoded tilesheets kept in memory, in bytes
+DEFAULT_IMAGE_BUDGET = 256 * 1024 * 1024
+# Frames of rendered animations kept in memory, in bytes
+DEFAULT_ANIMATION_BUDGET = 64 * 1024 * 1024
+
+# Frames, and their (offsetX, offsetY)
+TileAnimation = tuple[tuple[Image.Image, ...], tuple[tuple[int, int], ...]]
+# Part of a tilesheet used by a frame: (x, y, width, height, offsetX, offsetY)
+FrameRect = tuple[int, int, int, int, int, int]
+# Modes of tilesheets that can be rendered with NumPy, by number of channels (the last axis of their arrays)
+ARRAY_MODES = {2: "LA", 3: "RGB", 4: "RGBA"}
+
+
+def image_size(image: Image.Image) -> int:
+    "Approximate memory used by a decoded image, in bytes"
+    return image.width * image.height * len(image.getbands())
+
+
+def animation_size(animation: "TileAnimation") -> int:
+    "Approximate memory used by the frames of an animation, in bytes"
+    return sum(image_size(frame) for frame in animation[0])
+
+
+def array_size(array: "np.ndarray | None") -> int:
+    return array.nbytes if array is not None else 0
+
+
+def padded_size(rects: typing.Iterable[tuple[int, int, int, int]]) -> tuple[int, int]:
+    "Size of the frames of an animation, from the (width, height, offsetX, offsetY) of each frame"
+    rects = list(rects)
+    max_width = max(width + abs(offset_x) for width, _, offset_x, _ in rects)
+    max_height = max(height + abs(offset_y) for _, height, _, offset_y in rects)
+    # Make sure that they are divisible by 2 (required for some programs)
+    if max_width % 2:
+        max_width += 1
+    if max_height % 2:
+        max_height += 1
+    return max_width, max_height
+
+
+def open_image(path: Path) -> Image.Image:
+    "Open and decode an image immediately (`Image.open` is lazy, and keeps the file open until then)"
+    image = Image.open(path)
+    image.load()
+    return image
+
+
+def tint(image: Image.Image, color_rgb: typing.Sequence[float]) -> Image.Image:
+    """Multiply the red, green and blue channels by the given factors (rounded and clamped, alpha is kept),
+    like ImageMagick's `-channel Red -evaluate Multiply <factor>` for each channel.
+    Only the first 3 factors are used, any other (e.g. from a color with an alpha component) is ignored."""
+    if image.mode not in ("RGB", "RGBA"):
+        image = image.convert("RGBA")
+    # A lookup table per band, so that each pixel is a single lookup
+    table: list[int] = []
+    for factor in color_rgb[:3]:
+        table.extend(max(0, min(255, int(value * factor + 0.5))) for value in range(256))
+    if image.mode == "RGBA":
+        table.extend(range(256))
+    return image.point(table)
+
+
 class TileManager:
-    def __init__(self, data_folder: Path):
+    def __init__(
+            self, data_folder: Path,
+            image_budget: int = DEFAULT_IMAGE_BUDGET, animation_budget: int = DEFAULT_ANIMATION_BUDGET,
+    ):
         self.data_folder = data_folder
+        # Each tilesheet is decoded once, and shared by every tile and animation using it
+        self.images: LRUCache[Path, Image.Image] = LRUCache(image_budget, image_size)
+        # Results of get_tile_animation, by animation_key
+        self.rendered: LRUCache[typing.Hashable, TileAnimation] = LRUCache(animation_budget, animation_size)
+        # With NumPy: tilesheets as arrays, and the padded frames of each animation_key as a (frames, height, width, channels) array
+        self.arrays: LRUCache[Path, "np.ndarray"] = LRUCache(image_budget, array_size)
+        self.formatted: LRUCache[typing.Hashable, "np.ndarray"] = LRUCache(animation_budget, array_size)
+        # Width of each tilesheet image, read from its header (for `animation_key`, without decoding it)
+        self.widths: dict[Path, int] = {}
+        # (tile id, animation id) -> animation_key, so that repeated requests don't compute the frame rectangles again
+        self.keys: dict[tuple[str, str], typing.Hashable] = {}
         self.tilesheets: dict[Path, Tilesheet] = {}
         self.tiles: dict[str, Tile] = {}
         self.animations: dict[str, Animation] = {}
 
     # Part 1 - Load data
-    def load_tilesheet(self, sheet_id: Path, sheet: etree._Element | None) -> Tilesheet:
+    def load_tilesheet(self, sheet_id: Path, sheet: Element | None) -> Tilesheet:
         "Parses a <sheet> element, or a reference to a tilesheet which does not have an explicitly <sheet> tag (using default values)"
         if sheet is None:  # Default settings with no explicit <sheet>
             tilesheet = Tilesheet(
@@ -89,13 +229,13 @@ class TileManager:
                 frames=self.parse_frames(sheet),
             )
             for frame in tilesheet.frames:
-                for field in ('width', 'height', 'offsetX', 'offsetY'):
-                    if getattr(frame, field) is None:  # Set defaults for all Frames
-                        setattr(frame, field, getattr(tilesheet, field))
+                for attribute in ('width', 'height', 'offsetX', 'offsetY'):
+                    if getattr(frame, attribute) is None:  # Set defaults for all Frames
+                        setattr(frame, attribute, getattr(tilesheet, attribute))
         self.tilesheets[sheet_id] = tilesheet
         return tilesheet
 
-    def load_tile(self, source_file: Path, tile: etree._Element) -> Tile:
+    def load_tile(self, source_file: Path, tile: Element) -> Tile:
         "Parses a <tile> element"
         sheet_id = self.parse_source_sheet(source_file, tile.get("sheet", None))
         if sheet_id not in self.tilesheets:
@@ -114,7 +254,7 @@ class TileManager:
         self.tiles[result.id] = result
         return result
 
-    def load_animation(self, animation: etree._Element) -> Animation:
+    def load_animation(self, animation: Element) -> Animation:
         def _load(field: str):
             result = animation.get(field, None)
             if result is not None:
@@ -132,20 +272,24 @@ class TileManager:
 
     # Helpers for Part 1
     @staticmethod
-    def parse_frames(sheet: etree._Element) -> list[Frame]:
+    def parse_frames(sheet: Element) -> list[Frame]:
         "Parse <image> tags inside of a <sheet>. Returns an empty list if it has none."
         frames = []
-        frame: etree._Element
+        # frame index -> first Frame defined with it, for `equals=` frames to inherit from
+        defined: dict[int, Frame] = {}
+        frame: Element
         for frame in sheet.findall("image", None):
             fields = {}
             equals = frame.get("equals", None)
-            for field, default in _frame_defaults.items():
-                if equals is not None:
-                    default = _get_default(frames, int(equals), field, default)
-                result = frame.get(field, default)
-                fields[field] = int(result) if result is not None else None
+            source = defined.get(int(equals)) if equals is not None else None
+            for attribute, default in _frame_defaults.items():
+                if source is not None:
+                    default = getattr(source, attribute)
+                result = frame.get(attribute, default)
+                fields[attribute] = int(result) if result is not None else None
 
-            frames.append(Frame(**fields))
+            frames.append(parsed := Frame(**fields))
+            defined.setdefault(parsed.frame, parsed)
         frames.sort(key = lambda frame: frame.frame)
         return frames
 
@@ -158,17 +302,34 @@ class TileManager:
             return Path(source_file).parent / sheet_id
 
     # Part 2 - Load the Images
-    def get_tile_animation(self, tile_id: str, animation_id: str) -> tuple[list[Image.Image], list[tuple[int, int]]]:
-        # use the `single` animation if you want to load only a single frame
-        # Returns:
-        # - list of frames
-        # - list of (offsetX, offsetY) tuples
+    def get_tile_animation(self, tile_id: str, animation_id: str) -> TileAnimation:
+        """The frames of the animation, and their (offsetX, offsetY) offsets.
+        Use the `single` animation to load only a single frame.
+        The frames are not copied: the same Image objects are returned to every caller with the same `animation_key`,
+        so they must NOT be modified (copy them first)."""
+        return self.rendered.get(
+            self.animation_key(tile_id, animation_id),
+            lambda _: self._render_tile_animation(tile_id, animation_id),
+        )
+
+    def _render_tile_animation(self, tile_id: str, animation_id: str) -> TileAnimation:
+        tile = self.tiles[tile_id]
+        image = self.images.get(self.data_folder / tile.sheet.source_file, open_image)
+
+        frames = []
+        offsets = []
+        for x, y, width, height, offsetX, offsetY in self.frame_rects(tile_id, animation_id, image.width):
+            frames.append(image.crop((x, y, x + width, y + height)))
+            offsets.append((offsetX, offsetY))
+        return tuple(frames), tuple(offsets)
+
+    def frame_rects(self, tile_id: str, animation_id: str, sheet_width: int) -> list[FrameRect]:
+        "Where each frame of the animation is in the tilesheet (whose image is `sheet_width` pixels wide), and its offset"
         tile = self.tiles[tile_id]
         animation = self.animations[animation_id]
         sheet = tile.sheet
-        image = Image.open(self.data_folder / sheet.source_file)
 
-        n_cols = image.width // sheet.width
+        n_cols = sheet_width // sheet.width
         # n_rows = image.height // sheet.height
         base_position = ((animation.x or 0) + tile.x) + (((animation.y or 0) + tile.y) * n_cols)
         # base_position = (
@@ -176,13 +337,12 @@ class TileManager:
         #     + ((animation.y if animation.y is not None else tile.y) * n_cols)
         # )
 
-        frames = [] 
-        offsets = []
+        rects = []
         for count in range(animation.count):
             position = base_position + count
             if sheet.frames:
                 position = position % len(sheet.frames)
-                frame = next((frame for frame in sheet.frames if frame.frame == position))
+                frame = sheet.frame_index[position]
                 new_x, new_y = frame.x, frame.y
                 width, height = frame.width or sheet.width, frame.height or sheet.height
                 offsetX = (frame.offsetX or 0) + (animation.offsetX or 0)
@@ -193,25 +353,74 @@ class TileManager:
                 offsetY = sheet.offsetY + (animation.offsetY or 0)
                 new_y, new_x = divmod(position, n_cols)
                 new_y, new_x = new_y * height, new_x * width
+            rects.append((new_x, new_y, width, height, offsetX, offsetY))
+        return rects
 
-            img_frame = image.crop((
-                new_x, new_y,
-                new_x + width, new_y + height,
-            ))
-            frames.append(img_frame)
-            offsets.append((offsetX, offsetY))
-        return frames, offsets
+    def render_animation(self, tile_id: str, animation_id: str) -> list[Image.Image]:
+        """The frames of the animation, padded and offset (`format_animation` of `get_tile_animation`).
+        With NumPy, all frames are cut from the tilesheet's array and padded at once, and only converted to images at the end
+        (read-only images, sharing the memoized array)."""
+        if np is None:
+            return self.format_animation(*self.get_tile_animation(tile_id, animation_id))
+        sheet_file = self.data_folder / self.tiles[tile_id].sheet.source_file
+        sheet = self.arrays.get(sheet_file, self._load_array)
+        if sheet is None:  # Not a mode that NumPy can render
+            return self.format_animation(*self.get_tile_animation(tile_id, animation_id))
+        formatted = self.formatted.get(
+            self.animation_key(tile_id, animation_id),
+            lambda _: self._format_animation_array(sheet, self.frame_rects(tile_id, animation_id, sheet.shape[1])),
+        )
+        mode = ARRAY_MODES[formatted.shape[3]]
+        size = (formatted.shape[2], formatted.shape[1])
+        # Read-only images using the memory of the array, without copying it
+        return [Image.frombuffer(mode, size, frame, "raw", mode, 0, 1) for frame in formatted]
+
+    def _load_array(self, path: Path) -> "np.ndarray | None":
+        image = open_image(path)
+        if image.mode not in ARRAY_MODES.values():
+            return None
+        return np.asarray(image)
+
+    @staticmethod
+    def _format_animation_array(sheet: "np.ndarray", rects: list[FrameRect]) -> "np.ndarray":
+        "Same as cropping each frame, then `format_animation`, into a single (frames, height, width, channels) array"
+        max_width, max_height = padded_size((width, height, offset_x, offset_y) for _, _, width, height, offset_x, offset_y in rects)
+        output = np.zeros((len(rects), max_height, max_width, sheet.shape[2]), dtype=sheet.dtype)
+        sheet_height, sheet_width = sheet.shape[:2]
+        for i, (x, y, width, height, offset_x, offset_y) in enumerate(rects):
+            # Pixels of the frame that are both inside the tilesheet (as cropped) and inside the output (as pasted)
+            left = max(0, -x, -offset_x)
+            top = max(0, -y, -offset_y)
+            right = min(width, sheet_width - x, max_width - offset_x)
+            bottom = min(height, sheet_height - y, max_height - offset_y)
+            if left >= right or top >= bottom:
+                continue
+            output[i, offset_y + top:offset_y + bottom, offset_x + left:offset_x + right] = (
+                sheet[y + top:y + bottom, x + left:x + right]
+            )
+        return output
+
+    def animation_key(self, tile_id: str, animation_id: str) -> typing.Hashable:
+        """Identifies the result of `get_tile_animation`: it is the same for animations cutting the same rectangles,
+        with the same offsets, out of the same tilesheet image (e.g. through `equals=`, or different Tilesheets of one image)"""
+        key = self.keys.get((tile_id, animation_id))
+        if key is None:
+            source_file = self.tiles[tile_id].sheet.source_file
+            path = self.data_folder / source_file
+            if path not in self.widths:
+                with Image.open(path) as image:
+                    self.widths[path] = image.width
+            key = self.keys[tile_id, animation_id] = (
+                source_file, tuple(self.frame_rects(tile_id, animation_id, self.widths[path])),
+            )
+        return key
 
     @staticmethod
-    def format_animation(frames: list[Image.Image], offsets: list[tuple[int, int]]) -> list[Image.Image]:
+    def format_animation(frames: typing.Sequence[Image.Image], offsets: typing.Sequence[tuple[int, int]]) -> list[Image.Image]:
         "Pads and offsets all frames to fit in an animation sequence"
-        max_width = max(frame.width + abs(offset[0]) for frame, offset in zip(frames, offsets))
-        max_height = max(frame.height + abs(offset[1]) for frame, offset in zip(frames, offsets))
-        # Make sure that they are divisible by 2 (required for some programs)
-        if max_width % 2:
-            max_width += 1
-        if max_height % 2:
-            max_height += 1
+        max_width, max_height = padded_size(
+            (frame.width, frame.height, offset[0], offset[1]) for frame, offset in zip(frames, offsets)
+        )
         output = [Image.new(frame.mode, (max_width, max_height), 0) for frame in frames]
         for template, frame, offset in zip(output, frames, offsets):
             # anchor = (max_width - frame.width, max_height - frame.height)
@@ -221,29 +430,27 @@ class TileManager:
 
     # Part 3 - Utils
     @staticmethod
-    def iterate_elements(aggregated_xml: etree._ElementTree, element_name: str) -> list[tuple[Path, etree._Element]]:
-        result = []
-        for source in aggregated_xml.findall("./", None):
-            source_file = Path(source.get("source", None))
-            for element in source.findall(element_name, None):
-                result.append((source_file, element))
-        return result
+    def iterate_elements(aggregated: AggregatedData, element_name: str) -> list[tuple[Path, Element]]:
+        return aggregated.index.by_tag(element_name)
 
 
     @classmethod
-    def from_aggregated_xml(cls, data_folder: Path, aggregated_xml: etree._ElementTree) -> 'TileManager':
-        manager = TileManager(data_folder)
+    def from_aggregated_data(
+            cls, data_folder: Path, aggregated: AggregatedData,
+            image_budget: int = DEFAULT_IMAGE_BUDGET, animation_budget: int = DEFAULT_ANIMATION_BUDGET,
+    ) -> 'TileManager':
+        manager = TileManager(data_folder, image_budget, animation_budget)
 
         # Part 1) Tilesheets
         # Register all Tilesheets with an explicit definition
         # (with non-default settings such as setting its width, height or frames)
-        for source, sheet in manager.iterate_elements(aggregated_xml, "tilesheet"):
+        for source, sheet in manager.iterate_elements(aggregated, "tilesheet"):
             sheet_id = source.parent / sheet.get("id", None)
             manager.load_tilesheet(sheet_id, sheet)
 
         # Part 2) Tiles
         equal_tiles: dict[str, str] = {}
-        for source, tile in manager.iterate_elements(aggregated_xml, "tile"):
+        for source, tile in manager.iterate_elements(aggregated, "tile"):
             if (eq := tile.get("equals", None)) is not None:
                 equal_tiles[tile.get("id", None)] = eq
                 continue  # Handled later
@@ -258,7 +465,7 @@ class TileManager:
 
         del equal_tiles
 
-        for source, animation in manager.iterate_elements(aggregated_xml, "animation"):
+        for source, animation in manager.iterate_elements(aggregated, "animation"):
             manager.load_animation(animation)
 
         return manager
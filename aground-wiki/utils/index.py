@@ -0,0 +1,45 @@
+"Index of all the definitions of the aggregated data (e.g. every <item>), by tag and by id"
+
+from pathlib import Path
+import typing
+
+if typing.TYPE_CHECKING:
+    from utils.cache import Element
+
+# (source path, element)
+Entry = tuple[Path, "Element"]
+
+
+class DataIndex:
+    """Buckets the top-level elements of every source file (the definitions) by tag and by `id`.
+    Nested elements (such as the <item> requirements of a <recipe>) are references, and are not indexed."""
+    def __init__(self):
+        self._by_tag: dict[str, list[Entry]] = {}
+        self._by_id: dict[tuple[str, str], Entry] = {}
+
+    def add(self, source: Path, element: "Element"):
+        entry = (source, element)
+        self._by_tag.setdefault(element.tag, []).append(entry)
+        if (element_id := element.get("id", None)) is not None:
+            # Later definitions override earlier ones (e.g. mods)
+            self._by_id[element.tag, element_id] = entry
+
+    def by_tag(self, tag: str) -> list[Entry]:
+        "All the definitions with this tag, in document order"
+        return self._by_tag.get(tag, [])
+
+    def get(self, tag: str, element_id: str, default: Entry | None = None) -> Entry | None:
+        return self._by_id.get((tag, element_id), default)
+
+    def tags(self) -> typing.KeysView[str]:
+        return self._by_tag.keys()
+
+    @classmethod
+    def build(cls, roots: typing.Iterable["Element"]) -> "DataIndex":
+        "Index the children of every source file's root, in a single traversal"
+        index = cls()
+        for root in roots:
+            source = Path(root.get("source", None))
+            for element in root.children:
+                index.add(source, element)
+        return index
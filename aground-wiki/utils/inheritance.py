@@ -0,0 +1,78 @@
+"Resolves `extends=` inheritance between definitions, e.g. an <item> extending another <item>"
+
+import typing
+from pathlib import Path
+
+from utils.cache import Element
+from utils.index import DataIndex
+
+# Attributes identifying a definition (or used to look up its strings), which are never inherited
+NOT_INHERITED = frozenset(("id", "name"))
+
+
+class InheritanceResolver:
+    """Computes the effective version of definitions of one tag by following their `extends` chain:
+    attributes are inherited unless overridden (except for those in NOT_INHERITED),
+    and the parent's children come before the element's own.
+
+    Resolved definitions are memoized by id, so shared bases are only resolved once
+    and resolving every definition takes linear time overall.
+    Cycles and missing parents are reported, and the chain is cut where they happen."""
+    def __init__(self, index: DataIndex, tag: str):
+        self.index = index
+        self.tag = tag
+        self._resolved: dict[str, Element] = {}
+
+    def resolve(self, element: Element) -> Element:
+        "The effective version of `element` (the element itself if it doesn't extend anything)"
+        if self._is_canonical(element) and element.get("id", None) in self._resolved:
+            return self._resolved[element.get("id", None)]
+
+        # Walk up the chain until reaching a base or an already resolved parent
+        chain: list[Element] = [element]
+        seen: set[str | None] = {element.get("id", None)}
+        base: Element | None = None
+        while (parent_id := chain[-1].get("extends", None)) is not None:
+            if parent_id in self._resolved:
+                base = self._resolved[parent_id]
+                break
+            if parent_id in seen:
+                cycle = " -> ".join(str(e.get("id", None)) for e in chain)
+                print(f"Inheritance cycle for <{self.tag}>: {cycle} -> {parent_id}")
+                break
+            parent = self.index.get(self.tag, parent_id)
+            if parent is None:
+                print(f"<{self.tag} id={chain[-1].get('id', None)}> extends unknown {parent_id}")
+                break
+            seen.add(parent_id)
+            chain.append(parent[1])
+
+        # Then resolve back down, from the base to `element`
+        for original in reversed(chain):
+            current = original if base is None else Element(
+                original.tag,
+                {
+                    **{key: value for key, value in base.attrib.items() if key not in NOT_INHERITED},
+                    **original.attrib,
+                },
+                original.text if original.text is not None else base.text,
+                [*base.children, *original.children],
+            )
+            if self._is_canonical(original):
+                self._resolved[original.get("id", None)] = current
+            base = current
+        assert base is not None
+        return base
+
+    def _is_canonical(self, element: Element) -> bool:
+        "Whether `element` is the definition that its id refers to (and not one that got overridden, e.g. by a mod)"
+        element_id = element.get("id", None)
+        if element_id is None:
+            return False
+        entry = self.index.get(self.tag, element_id)
+        return entry is not None and entry[1] is element
+
+    def resolve_all(self) -> typing.Generator[tuple[Path, Element], None, None]:
+        "The effective version of every definition, with its source path"
+        for source, element in self.index.by_tag(self.tag):
+            yield source, self.resolve(element)
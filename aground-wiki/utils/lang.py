@@ -0,0 +1,63 @@
+"Translated strings from the <lang> definitions"
+
+import sys
+import typing
+
+from utils.index import DataIndex
+
+
+class LanguageTable:
+    """Translated strings of the loaded locales, stored once per text (interned) under a normalised `section>text` key.
+    Keys using `.` as the connector (`section.text`) are normalised when looking them up."""
+    def __init__(self, locales: typing.Iterable[str] | None = None):
+        # None to load every locale
+        self.locales = set(locales) if locales is not None else None
+        self._strings: dict[str, dict[str, str]] = {}
+
+    def add(self, locale: str, section_id: str, text_id: str, text: str):
+        key = sys.intern(section_id + ">" + text_id)
+        self._strings.setdefault(locale, {})[key] = sys.intern(text)
+
+    def get(self, locale: str, key: str, default: str | None = None) -> str | None:
+        strings = self._strings.get(locale, {})
+        if ">" in key:
+            return strings.get(key, default)
+        # `section.text`, where both the section and the text may themselves contain dots
+        position = len(key)
+        while (position := key.rfind(".", 0, position)) != -1:
+            result = strings.get(key[:position] + ">" + key[position + 1:])
+            if result is not None:
+                return result
+        return default
+
+    def lookup(self, locale: str, keys: typing.Iterable[str]) -> str | None:
+        "The string of the first key that exists"
+        for key in keys:
+            if (result := self.get(locale, key)) is not None:
+                return result
+        return None
+
+    def resolve(self, locale: str, candidates: dict[str, typing.Sequence[str]]) -> dict[str, str | None]:
+        "Batch version of `lookup`, as {id: string} from {id: keys}"
+        return {element_id: self.lookup(locale, keys) for element_id, keys in candidates.items()}
+
+    def __contains__(self, locale: str) -> bool:
+        return locale in self._strings
+
+    def loaded_locales(self) -> typing.KeysView[str]:
+        "The locales that have at least one string"
+        return self._strings.keys()
+
+    @classmethod
+    def from_index(cls, index: DataIndex, locales: typing.Iterable[str] | None = None) -> "LanguageTable":
+        "Load the given locales (or all of them) from every <lang> definition"
+        table = cls(locales)
+        for _, lang in index.by_tag("lang"):
+            locale = lang.get("id", None)
+            if table.locales is not None and locale not in table.locales:
+                continue
+            for section in lang.findall("section", None):
+                section_id = section.get("id", None)
+                for text in section.findall("text", None):
+                    table.add(locale, section_id, text.get("id", None), (text.text or "").strip())
+        return table
@@ -0,0 +1,90 @@
+"""Relationships between definitions of the aggregated data (e.g. which enemies drop an item),
+built in a single pass and queryable in both directions"""
+
+import typing
+
+from utils.cache import Element
+from utils.index import DataIndex
+
+# (relation, id of the element that declares it, id it refers to)
+Edge = tuple[str, str | None, str | None]
+Extractor = typing.Callable[[Element], typing.Iterable[Edge]]
+
+
+class RelationGraph:
+    "Typed edges between ids, stored as adjacency lists in both directions (duplicates and order are kept)"
+    def __init__(self):
+        # relation -> source id -> target ids
+        self._targets: dict[str, dict[str | None, list[str | None]]] = {}
+        # relation -> target id -> source ids
+        self._sources: dict[str, dict[str | None, list[str | None]]] = {}
+
+    def add(self, relation: str, source: str | None, target: str | None):
+        self._targets.setdefault(relation, {}).setdefault(source, []).append(target)
+        self._sources.setdefault(relation, {}).setdefault(target, []).append(source)
+
+    def targets(self, relation: str, source: str | None) -> list[str | None]:
+        "The ids that `source` refers to, e.g. targets('loot', enemy_id) -> item ids"
+        return self._targets.get(relation, {}).get(source, [])
+
+    def sources(self, relation: str, target: str | None) -> list[str | None]:
+        "The ids that refer to `target`, e.g. sources('loot', item_id) -> enemy ids"
+        return self._sources.get(relation, {}).get(target, [])
+
+    def relations(self) -> typing.KeysView[str]:
+        return self._targets.keys()
+
+
+def enemy_edges(enemy: Element) -> typing.Iterable[Edge]:
+    "enemy -> the items it drops"
+    loot_sets: list[Element] = []
+    loots: list[Element] = []
+    for child in enemy.children:
+        if child.tag == "lootSet":
+            loot_sets.extend(child.findall("loot", None))
+        elif child.tag == "loot":
+            loots.append(child)
+    for loot in (*loot_sets, *loots):
+        if (item_id := loot.get("id", None)) is not None:
+            yield "loot", enemy.get("id", None), item_id
+
+
+def quest_edges(quest: Element) -> typing.Iterable[Edge]:
+    "quest -> the items it requires"
+    for item in quest.findall("item", None):
+        yield "quest_requires", quest.get("id", None), item.get("id", None)
+
+
+def recipe_edges(recipe: Element) -> typing.Iterable[Edge]:
+    "recipe -> the item it creates, and the items it requires"
+    recipe_id = recipe.get("id", None)
+    yield "recipe_creates", recipe_id, recipe.get("creates", None)
+    for item in recipe.findall("item", None):
+        yield "ingredient", recipe_id, item.get("id", None)
+
+
+def item_edges(item: Element) -> typing.Iterable[Edge]:
+    "familiar item -> the items it eats"
+    if item.find("familiar", None) is None:
+        return
+    for food in item.findall("food", None):
+        yield "familiar_food", item.get("id", None), food.get("id", None)
+
+
+# tag -> function listing the edges declared by one such element
+EXTRACTORS: dict[str, Extractor] = {
+    "enemy": enemy_edges,
+    "quest": quest_edges,
+    "recipe": recipe_edges,
+    "item": item_edges,
+}
+
+
+def build(index: DataIndex, extractors: dict[str, Extractor] = EXTRACTORS) -> RelationGraph:
+    "Visit every relevant definition once, collecting the edges of all relations"
+    graph = RelationGraph()
+    for tag, extract in extractors.items():
+        for _, element in index.by_tag(tag):
+            for relation, source, target in extract(element):
+                graph.add(relation, source, target)
+    return graph
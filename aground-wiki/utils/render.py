@@ -0,0 +1,225 @@
+"""Parallel rendering of images cut out of tilesheets:
+jobs are grouped by tilesheet and spread over a process pool, and each process saves its images on a thread pool"""
+
+import argparse
+import itertools
+import math
+import os
+import shutil
+import typing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from PIL import Image
+
+from utils.images import LRUCache, TileManager
+
+J = typing.TypeVar("J")
+S = typing.TypeVar("S")
+
+
+class Output(typing.NamedTuple):
+    file: Path
+    image: Image.Image
+    # Called with the file once it is saved, e.g. to post-process it
+    after_save: typing.Callable[[Path], None] | None = None
+    # What the image is (e.g. an item id, and its frame number), when collected instead of saved (e.g. for an atlas)
+    name: str | None = None
+    frame: int = 0
+    # Passed to `Image.save`, e.g. to save an animation
+    options: dict | None = None
+    # Other files with the same content, linked to `file` once it is saved
+    links: tuple[Path, ...] = ()
+
+
+# (state, job) -> images to save. Must be a module-level function, so that it can be sent to other processes
+Renderer = typing.Callable[[S, J], typing.Iterable[Output]]
+# state -> the caches it uses (e.g. of decoded tilesheets) by name, to report their statistics
+CacheGetter = typing.Callable[[S], dict[str, LRUCache]]
+
+
+def caches(state: TileManager | tuple) -> dict[str, LRUCache]:
+    "CacheGetter for the caches of a TileManager, given as the state or as the first item of a tuple state"
+    manager: TileManager = state[0] if isinstance(state, tuple) else state
+    return {
+        "tilesheets": manager.images, "animations": manager.rendered,
+        "tilesheet arrays": manager.arrays, "formatted animations": manager.formatted,
+    }
+
+
+def add_workers_argument(argparser: argparse.ArgumentParser, doing: str = "rendering"):
+    "Add the -j/--workers option, the number of processes (see `render_all`) doing the work"
+    argparser.add_argument(
+        "-j", "--workers", type=int, default=os.cpu_count() or 1,
+        help=f"Number of processes {doing} in parallel, 1 to run everything in this process (default: CPU count)",
+    )
+
+
+@dataclass
+class RenderStats:
+    jobs: int = 0
+    files: int = 0
+    # Files linked to an identical render instead of being rendered again
+    links: int = 0
+    # cache name -> [hits, misses], summed over every process
+    caches: dict[str, list[int]] = field(default_factory=dict)
+
+    def __iadd__(self, other: "RenderStats") -> "RenderStats":
+        self.jobs += other.jobs
+        self.files += other.files
+        self.links += other.links
+        for name, (hits, misses) in other.caches.items():
+            counts = self.caches.setdefault(name, [0, 0])
+            counts[0] += hits
+            counts[1] += misses
+        return self
+
+    def __str__(self) -> str:
+        links = f", linked {self.links} identical files" if self.links else ""
+        caches = "; ".join(
+            f"{name}: {hits} hits, {misses} misses" for name, (hits, misses) in self.caches.items() if hits or misses
+        )
+        return f"Rendered {self.files} images for {self.jobs} jobs{links}" + (f" (cache of {caches})" if caches else "")
+
+
+# State shared by every job of a process (e.g. the TileManager), set once when the process starts
+_state = None
+
+
+def _init_worker(state):
+    global _state
+    _state = state
+
+
+def link(source: Path, target: Path):
+    "Hardlink `target` to `source`, or copy it if the file system doesn't support it"
+    target.unlink(missing_ok=True)
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copyfile(source, target)
+
+
+def _save(output: Output):
+    # The file may be a link to another one from a previous run, which must not be overwritten along with it
+    output.file.unlink(missing_ok=True)
+    output.image.save(output.file, **(output.options or {}))
+    if output.after_save is not None:
+        output.after_save(output.file)
+    for target in output.links:
+        link(output.file, target)
+
+
+def render_group(
+        render: Renderer, jobs: list, threads: int, get_caches: CacheGetter | None = None, collect: bool = False,
+) -> tuple[RenderStats, list[Output]]:
+    """Render jobs using the same tilesheet (decoded once in this process), while the previous images are saved on threads.
+    With `collect`, the images are returned instead of being saved."""
+    caches = get_caches(_state) if get_caches is not None else {}
+    before = {name: (cache.hits, cache.misses) for name, cache in caches.items()}
+    stats = RenderStats(jobs=len(jobs))
+    if collect:
+        outputs = [output for job in jobs for output in render(_state, job)]
+        stats.files = len(outputs)
+    else:
+        outputs = []
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            futures = []
+            for job in jobs:
+                for output in render(_state, job):
+                    futures.append(executor.submit(_save, output))
+                    stats.links += len(output.links)
+        for future in futures:
+            future.result()  # Raise the errors of the saves, if any
+        stats.files = len(futures)
+    for name, cache in caches.items():
+        hits, misses = before[name]
+        stats.caches[name] = [cache.hits - hits, cache.misses - misses]
+    return stats, outputs
+
+
+def group_jobs(jobs: typing.Iterable[J], sheet_of: typing.Callable[[J], typing.Hashable], workers: int) -> list[list[J]]:
+    """Group the jobs by tilesheet, then split large groups so that all workers get some of the work.
+    Each worker only decodes the tilesheets of the groups it gets."""
+    by_sheet: dict[typing.Hashable, list[J]] = {}
+    for job in jobs:
+        by_sheet.setdefault(sheet_of(job), []).append(job)
+    total = sum(len(group) for group in by_sheet.values())
+    # A few chunks per worker, to balance the load
+    chunk_size = max(1, math.ceil(total / (workers * 4)))
+    return [
+        group[start:start + chunk_size]
+        for group in by_sheet.values()
+        for start in range(0, len(group), chunk_size)
+    ]
+
+
+def group_duplicates(
+        jobs: dict[str, J], content_of: typing.Callable[[J], typing.Hashable],
+) -> list[tuple[tuple[str, ...], J]]:
+    """Group the jobs (by output name) that would render the same images, e.g. the same tilesheet, rectangle and tint.
+    Each group is rendered once, for its first name, and the other names get links to the result."""
+    by_content: dict[typing.Hashable, tuple[list[str], J]] = {}
+    for name, job in jobs.items():
+        by_content.setdefault(content_of(job), ([], job))[0].append(name)
+    return [(tuple(names), job) for names, job in by_content.values()]
+
+
+def _run(
+        jobs: typing.Iterable[J],
+        sheet_of: typing.Callable[[J], typing.Hashable],
+        render: Renderer,
+        state,
+        workers: int | None,
+        threads: int,
+        get_caches: CacheGetter | None,
+        collect: bool,
+) -> tuple[RenderStats, list[Output]]:
+    workers = workers or os.cpu_count() or 1
+    groups = group_jobs(jobs, sheet_of, workers)
+    stats = RenderStats()
+    outputs: list[Output] = []
+    if workers <= 1 or len(groups) <= 1:
+        _init_worker(state)
+        results = (render_group(render, group, threads, get_caches, collect) for group in groups)
+        for group_stats, group_outputs in results:
+            stats += group_stats
+            outputs.extend(group_outputs)
+        return stats, outputs
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(state,)) as executor:
+        for group_stats, group_outputs in executor.map(
+            render_group, itertools.repeat(render), groups,
+            itertools.repeat(threads), itertools.repeat(get_caches), itertools.repeat(collect),
+        ):
+            stats += group_stats
+            outputs.extend(group_outputs)
+    return stats, outputs
+
+
+def render_all(
+        jobs: typing.Iterable[J],
+        sheet_of: typing.Callable[[J], typing.Hashable],
+        render: Renderer,
+        state,
+        workers: int | None = None,
+        threads: int = 4,
+        get_caches: CacheGetter | None = None,
+) -> RenderStats:
+    """Render every job, with `render(state, job)` called in one of `workers` processes (default: CPU count).
+    Jobs writing the same file must not be rendered together, as there is no guarantee of which one would be saved last."""
+    return _run(jobs, sheet_of, render, state, workers, threads, get_caches, collect=False)[0]
+
+
+def collect_all(
+        jobs: typing.Iterable[J],
+        sheet_of: typing.Callable[[J], typing.Hashable],
+        render: Renderer,
+        state,
+        workers: int | None = None,
+        get_caches: CacheGetter | None = None,
+) -> tuple[RenderStats, list[Output]]:
+    """Same as `render_all`, but the images are sent back to this process instead of being saved (e.g. to build an atlas).
+    They come in the order of the jobs, grouped by tilesheet."""
+    return _run(jobs, sheet_of, render, state, workers, 1, get_caches, collect=True)
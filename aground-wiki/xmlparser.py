@@ -1,41 +1,73 @@
 """
 Custom XML Parser created to convert Aground XML files into a more standard format
 (in particular, `&&`, `<` and such existing where they shouldn't causes normal parsers to error)
+
+Two engines implement the same grammar, selectable with `parse(text, engine=...)`:
+- "index" (default): `IndexParser`, scans the text by position and slices out whole tokens
+- "deque": `Parser`, the original character-by-character implementation, kept for comparison
 """
 
 import collections
+import io
+import re
 import textwrap
+import types
 import typing
 
 
+# Bump whenever a change to the parser or the writer changes the output, so that cached results are invalidated
+PARSER_VERSION = 2
+
+
+# Shared by all nodes without attributes / children, which are the vast majority. Both are immutable.
+NO_ATTRIBUTES: typing.Mapping[str, str] = types.MappingProxyType({})
+NO_CHILDREN: tuple["XmlNode", ...] = ()
+
+
 class XmlNode:
-    def __init__(self, name: str, attributes: dict[str, str], children: list["XmlNode"], text: str):
+    __slots__ = ("name", "attributes", "children", "text")
+
+    def __init__(
+        self,
+        name: str,
+        attributes: typing.Mapping[str, str] = NO_ATTRIBUTES,
+        children: typing.Sequence["XmlNode"] = NO_CHILDREN,
+        text: str = "",
+    ):
         self.name = name
-        self.attributes = attributes
-        self.children = children
+        self.attributes = attributes or NO_ATTRIBUTES
+        self.children = children or NO_CHILDREN
         self.text = text
     
-    def to_string(self):
-        _attrs = " ".join(f'''{key}="{value}"''' for key, value in self.attributes.items())
-        if _attrs:
-            _attrs = ' ' + _attrs
-        if self.children:
-            _child = "\n".join(child.to_string() for child in self.children)
-            _child = textwrap.indent(_child, "    ")
-            return f"""<{self.name}{_attrs}>\n{_child}\n</{self.name}>"""
-        elif self.text:
-            if '\n' in self.text:
-                text = textwrap.indent(textwrap.dedent(self.text).strip(), "    ")
-                return f"""<{self.name}{_attrs}>\n{text}\n</{self.name}>"""
+    def to_string(self) -> str:
+        buffer = io.StringIO()
+        self.write(buffer)
+        return buffer.getvalue()
+
+    def write(self, file: typing.TextIO):
+        "Write this node as XML to a file, iteratively (so deep trees are fine), see `XmlWriter`"
+        writer = XmlWriter(file)
+        # (node, whether it's closing) in reverse order
+        stack: list[tuple[XmlNode, bool]] = [(self, False)]
+        while stack:
+            node, closing = stack.pop()
+            if closing:
+                writer.end(node.name)
+                continue
+            writer.start(node.name, node.attributes)
+            if node.children:
+                # The text is ignored when there are children
+                stack.append((node, True))
+                stack.extend((child, False) for child in reversed(node.children))
             else:
-                return f"""<{self.name}{_attrs}>{self.text}</{self.name}>"""
-        else:
-            return f"""<{self.name}{_attrs}/>"""
+                writer.data(node.text)
+                writer.end(node.name)
+        writer.close()
     
     def to_dict(self):
         result = {
             "name": self.name,
-            "attributes": self.attributes,
+            "attributes": dict(self.attributes),
         }
         if self.children:
             result["children"] = [child.to_dict() for child in self.children]
@@ -55,9 +87,10 @@ class XmlNode:
         return f"XmlNode({self.name}{_id}, attributes={set(self.attributes)}, children={[child.name for child in self.children]})"
 
 class Parser:
-    def __init__(self, text: str):
+    def __init__(self, text: str, keep_whitespace: bool = True):
         self._text = text
         self.buffer = collections.deque(text)
+        self.keep_whitespace = keep_whitespace
 
     
     def parse(self):
@@ -83,6 +116,8 @@ class Parser:
         assert has_children is not None
         if has_children:
             children, text = self.parse_children(name)
+            if not self.keep_whitespace and text.isspace():
+                text = ""
         else:
             children = []
             text = ""
@@ -170,8 +205,302 @@ class Parser:
                 text += character
 
 
-def parse(text: str) -> XmlNode:
-    return Parser(text).parse()
+# Event types generated by `iterparse`:
+# - (START, name, attributes) when an element is opened
+# - (TEXT, text) for text between two tags, only ever inside of an element
+# - (END, name) when an element is closed (including self-closing ones)
+START = "start"
+TEXT = "text"
+END = "end"
+Event = tuple[str, str] | tuple[str, str, dict[str, str]]
+
+_NAME_END = re.compile(r"[ />]")
+_ATTRIBUTE_END = re.compile(r"[=/>]")
+# Fast path for the common, well-formed case: a whole start tag with quoted attributes, read in one go.
+# As in `read_name`, the name ends at the first space (so any whitespace around it is dropped),
+# and attributes may be separated by any whitespace, e.g. split over several lines.
+_START_TAG = re.compile(
+    r"""([^\s/>]*)(?:[^\S ]* ((?:\s*[^\s=/>]+=(?:"[^"]*"|'[^']*'))*)\s*)?(/?)>"""
+)
+# name, value if double quoted, value if single quoted
+_ATTRIBUTE = re.compile(r"""([^\s=/>]+)=(?:"([^"]*)"|'([^']*)')""")
+
+
+def _strip_whitespace(string: str) -> str:
+    "Remove all whitespace from a name, as the character-by-character parser skips it"
+    return "".join(string.split())
+
+
+class IndexParser:
+    """Same grammar as `Parser`, but scans the original string by position instead of popping characters,
+    jumping to the next `<`, `>` or quote with `str.find` and slicing out whole tokens at once.
+    Nested elements are tracked with an explicit stack instead of recursion."""
+    def __init__(self, text: str, keep_whitespace: bool = True):
+        self._text = text
+        self.position = 0
+        self.keep_whitespace = keep_whitespace
+
+    def parse(self):
+        self.skip_prolog()
+        return self.parse_element()
+
+    def skip_prolog(self):
+        "Move to the name of the root element, skipping the header and comments before the start of the file"
+        text = self._text
+        position = 0
+        while True:
+            position = text.find("<", position)
+            if position == -1 or position + 1 >= len(text):
+                raise Exception('unexpected state')
+            position += 1
+            if text[position] not in "?!":
+                self.position = position
+                return
+
+    def parse_element(self):
+        "Parse the element whose name starts at the current position, along with all of its descendants"
+        # (name, attributes, children, text parts) of every element that is still open
+        stack: list[tuple[str, dict[str, str], list[XmlNode], list[str]]] = []
+        keep_whitespace = self.keep_whitespace
+        for event in self.iter_element_events():
+            kind = event[0]
+            if kind is TEXT:
+                stack[-1][3].append(event[1])
+            elif kind is START:
+                stack.append((event[1], event[2], [], []))
+            else:
+                name, attributes, children, text_parts = stack.pop()
+                text = "".join(text_parts)
+                if not keep_whitespace and text.isspace():
+                    text = ""
+                node = XmlNode(name, attributes, children, text)
+                if not stack:
+                    return node
+                stack[-1][2].append(node)
+        raise Exception("Unexpected end of file")
+
+    def iter_events(self) -> typing.Generator[Event, None, None]:
+        "Generate the events of the root element and its descendants, see `iterparse`"
+        self.skip_prolog()
+        yield from self.iter_element_events()
+
+    def iter_element_events(self) -> typing.Generator[Event, None, None]:
+        "Generate the events of the element whose name starts at the current position"
+        text = self._text
+        # names of every element that is still open
+        stack: list[str] = []
+        while True:
+            name, attributes, has_children = self.read_start_tag()
+            yield START, name, attributes
+            if has_children:
+                stack.append(name)
+            else:
+                yield END, name
+                if not stack:
+                    return
+
+            while True:
+                name = stack[-1]
+                start = text.find("<", self.position)
+                if start == -1:
+                    raise Exception("Unexpected end of file")
+                # random text (e.g. inside of <action> or <text>). Also ends up catching a lot of whitespace junk.
+                if start > self.position:
+                    yield TEXT, text[self.position:start]
+                self.position = start + 1
+                # <!-- comments -->
+                if text.startswith("!", self.position):
+                    end = text.find("-->", self.position + 1)
+                    if end == -1:
+                        raise Exception("Unexpected end of file")
+                    self.position = end + 3
+                    continue
+                # </closing>
+                if text.startswith("/", self.position) and text.startswith(name, self.position + 1):
+                    end = text.find(">", self.position)
+                    if end == -1:
+                        raise Exception("Unexpected end of file")
+                    self.position = end + 1
+                    stack.pop()
+                    yield END, name
+                    if not stack:
+                        return
+                    continue
+                # <child>
+                break
+
+    def read_start_tag(self) -> tuple[str, dict[str, str], bool]:
+        "Read a start tag, returning its name, its attributes and whether it may have children"
+        match = _START_TAG.match(self._text, self.position)
+        if match is not None:
+            name, attributes, self_closing = match.groups()
+            self.position = match.end()
+            if not attributes:
+                return name, {}, not self_closing
+            return name, {
+                attribute: double_quoted or single_quoted
+                for attribute, double_quoted, single_quoted in _ATTRIBUTE.findall(attributes)
+            }, not self_closing
+        name, has_attributes, has_children = self.read_name()
+        if has_attributes:
+            attributes, has_children = self.parse_attributes()
+        else:
+            attributes = {}
+        assert has_children is not None
+        return name, attributes, has_children
+
+    def read_name(self):
+        text = self._text
+        match = _NAME_END.search(text, self.position)
+        if match is None:
+            raise Exception("Unexpected end of file")
+        name = _strip_whitespace(text[self.position:match.start()])
+        self.position = match.end()
+        character = match.group()
+        # <name ; may have attributes ; may or may not have children
+        if character == ' ':
+            return name, True, None
+        # <name/> ; must not have attributes ; must not have children
+        elif character == "/":
+            assert text[self.position] == ">"
+            self.position += 1
+            return name, False, False
+        # <name> ; must not have attributes ; may have children
+        else:
+            return name, False, True
+
+    def parse_attributes(self):
+        text = self._text
+        attributes = {}
+        while True:
+            match = _ATTRIBUTE_END.search(text, self.position)
+            if match is None:
+                raise Exception("Unexpected end of file")
+            character = match.group()
+            if character == "/":
+                if text[match.end()] != ">":
+                    raise Exception("Unexpected state")
+                self.position = match.end() + 1
+                return attributes, False
+            elif character == ">":
+                self.position = match.end()
+                return attributes, True
+            name = _strip_whitespace(text[self.position:match.start()])
+            start_quote = text[match.end()]
+            value_start = match.end() + 1
+            value_end = text.find(start_quote, value_start)
+            if value_end == -1:
+                raise Exception("Unexpected end of file")
+            attributes[name] = text[value_start:value_end]
+            self.position = value_end + 1
+
+
+ENGINES: dict[str, type[Parser] | type[IndexParser]] = {
+    "index": IndexParser,
+    "deque": Parser,
+}
+
+
+def parse(text: str, engine: str = "index", keep_whitespace: bool = True) -> XmlNode:
+    """Parse a (possibly non-standard) Aground XML file. `engine` selects the parser implementation, see `ENGINES`.
+    With `keep_whitespace=False`, whitespace-only text (e.g. the indentation between children) is dropped."""
+    return ENGINES[engine](text, keep_whitespace).parse()
+
+
+def iterparse(text: str) -> typing.Generator[Event, None, None]:
+    "Parse a (possibly non-standard) Aground XML file incrementally, generating events instead of building a tree"
+    return IndexParser(text).iter_events()
+
+
+# All characters that `str.splitlines` (and therefore `textwrap.indent`) treats as line boundaries
+_LINE_BREAK = re.compile("[\n\r\v\f\x1c\x1d\x1e\x85\u2028\u2029]")
+
+
+def _indent(text: str, prefix: str) -> str:
+    "Same as `textwrap.indent`, with a fast path for single lines"
+    if _LINE_BREAK.search(text) is None:
+        return prefix + text if text.strip() else text
+    return textwrap.indent(text, prefix)
+
+
+class XmlWriter:
+    """Streaming counterpart of `XmlNode.to_string`, producing the exact same output from parser events.
+    Only the opening tag and text of the elements that are still open are kept in memory.
+
+    Follows the same interface as lxml's parser targets (`start`, `data`, `end`, `close`).
+    If given, `transform` is applied to every attribute value and text (e.g. for escaping)."""
+    def __init__(self, file: typing.TextIO, transform: typing.Callable[[str], str] | None = None, indent: str = "    "):
+        self.file = file
+        self.transform = transform
+        self.indent = indent
+        # [name, opening tag, text parts, has children] of every element that is still open
+        self._stack: list[list] = []
+        self._separator = ""
+
+    def _write(self, text: str, depth: int):
+        self.file.write(self._separator + (_indent(text, self.indent * depth) if depth else text))
+        self._separator = "\n"
+
+    def start(self, name: str, attributes: dict[str, str]):
+        if self._stack:
+            parent = self._stack[-1]
+            if not parent[3]:
+                # The parent's text is not written once it has children
+                self._write(parent[1] + ">", len(self._stack) - 1)
+                parent[2] = None
+                parent[3] = True
+        transform = self.transform
+        if not attributes:
+            opening = "<" + name
+        elif transform is None:
+            opening = "<" + name + "".join([f' {key}="{value}"' for key, value in attributes.items()])
+        else:
+            opening = "<" + name + "".join([f' {key}="{transform(value)}"' for key, value in attributes.items()])
+        self._stack.append([name, opening, [], False])
+
+    def data(self, text: str):
+        parts = self._stack[-1][2]
+        if parts is not None:
+            parts.append(text)
+
+    def end(self, name: str):
+        depth = len(self._stack) - 1
+        _name, opening, parts, has_children = self._stack.pop()
+        if has_children:
+            self._write(f"</{name}>", depth)
+            return
+        text = "".join(parts)
+        if self.transform:
+            text = self.transform(text)
+        if not text:
+            self._write(opening + "/>", depth)
+        elif '\n' in text:
+            self._write(opening + ">", depth)
+            self._write(textwrap.dedent(text).strip(), depth + 1)
+            self._write(f"</{name}>", depth)
+        else:
+            self._write(f"{opening}>{text}</{name}>", depth)
+
+    def close(self):
+        assert not self._stack, "Unclosed elements"
+
+    def feed(self, events: typing.Iterable[Event]):
+        "Write all events, as generated by `iterparse`"
+        for event in events:
+            kind = event[0]
+            if kind is START:
+                self.start(event[1], event[2])
+            elif kind is TEXT:
+                self.data(event[1])
+            else:
+                self.end(event[1])
+
+
+def write_events(events: typing.Iterable[Event], file: typing.TextIO, transform: typing.Callable[[str], str] | None = None):
+    "Convert parser events into standard XML, written to `file` in a single pass"
+    writer = XmlWriter(file, transform)
+    writer.feed(events)
+    writer.close()
 
 if __name__ == "__main__":
 
@@ -183,7 +512,7 @@ if __name__ == "__main__":
     data = parser.parse()
 
     with (pathlib.Path(__file__).parent / 'test_out.xml').open('w') as file:
-        file.write(data.to_string())
+        data.write(file)
 
     import json
     with (pathlib.Path(__file__).parent / 'test_out.json').open('w') as file: